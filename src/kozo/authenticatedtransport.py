@@ -1,4 +1,5 @@
 import socket # Required for socket.timeout
+import time
 import paramiko
 from .kozo import *
 from .log import *
@@ -44,12 +45,15 @@ class AuthenticatedTransport(Transport):
 		self._privateKey = paramiko.RSAKey.from_private_key_file(self.getNode().getPrivateKeyPath())
 	def connect(self, otherTransport):
 		assert self._privateKey is not None
-		addresses = self.getUnauthenticatedConnectAddresses(otherTransport)
-		for addressIndex, address in enumerate(addresses):
+		linkStats = kozoRuntime().getLinkStats()
+		addresses = linkStats.sort(enumerate(self.getUnauthenticatedConnectAddresses(otherTransport)), key=lambda (addressIndex, address): (self, otherTransport, address))
+		for addressIndex, address in addresses:
+			start = time.time()
 			try:
 				unauthenticatedSocket = self.getUnauthenticatedSocket(otherTransport, addressIndex, address)
 				if unauthenticatedSocket is None:
 					infoTransport(self, 'Failed to connect to', address, '(No socket returned)')
+					linkStats.failed((self, otherTransport, address))
 					continue
 				transport = paramiko.Transport(unauthenticatedSocket)
 				_initializeParamikoTransport(transport)
@@ -57,12 +61,15 @@ class AuthenticatedTransport(Transport):
 				hostKey = transport.get_remote_server_key()
 				if not _publicKeyCompare(hostKey, otherTransport.getNode().getPublicKey()):
 					warnTransport(self, 'Got an invalid host key when connecting to', otherTransport)
+					linkStats.failed((self, otherTransport, address))
 					continue
 				transport.auth_publickey('', self._privateKey)
 				channel = transport.open_channel('kozo')
+				linkStats.succeeded((self, otherTransport, address), time.time() - start)
 				return AuthenticatedChannel(self.getNode(), otherTransport.getNode(), channel)
 			except BaseException as e:
 				infoTransport(self, 'Failed to connect to', address, e, printTraceback=False)
+				linkStats.failed((self, otherTransport, address))
 	def accept(self):
 		infoTransport(self, 'Waiting for a connection')
 		connection = self.acceptUnauthenticatedConnection()
@@ -120,10 +127,15 @@ class AuthenticatedChannel(Channel):
 	def send(self, bytes):
 		return self._authenticatedChannel.send(bytes)
 	def receive(self, bytes, timeout):
+		previousTimeout = self._authenticatedChannel.gettimeout()
 		self._authenticatedChannel.settimeout(timeout)
 		try:
 			return self._authenticatedChannel.recv(bytes)
 		except socket.timeout: # Sent by Paramiko, not the underlying socket
 			return None
+		finally:
+			self._authenticatedChannel.settimeout(previousTimeout) # The timeout also applies to sends
+	def fileno(self):
+		return self._authenticatedChannel.fileno()
 	def __str__(self):
 		return 'Auth' + Channel.__str__(self)
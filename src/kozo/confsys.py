@@ -22,6 +22,7 @@ class Config(object):
 		for key in requiredKeys:
 			if key not in providedConfig:
 				raise ValueError('Must provide a value for', context, '->', key)
+		self._context = context
 		self._consistency = consistency
 		self._provided = providedConfig.copy()
 		self._default = defaultConfig.copy()
@@ -38,12 +39,20 @@ class Config(object):
 				raise KozoError('Unknown configuration option', key, '; Allowed:', tuple(self._allowedKeys))
 	def overrideWith(self, override):
 		if isinstance(override, Config):
-			self._provided.update(override._provided)
-		else:
-			self._provided.update(override)
+			override = override._provided
+		for key, value in override.items():
+			if type(self._default.get(key)) is type({}) and not isinstance(value, Config):
+				# Nested options are merged with the ones already provided, and stay lenient about unknown keys.
+				merged = self._provided[key]._provided.copy()
+				merged.update(value or {})
+				self._provided[key] = Config(self._context, merged, self._default[key], [], False)
+			else:
+				self._provided[key] = value
 		self._consistencyCheck()
 	def __getitem__(self, key):
 		return self._provided.get(key, self._default.get(key, None))
+	def get(self, key):
+		return self[key]
 	def __setitem__(self, key, value):
 		self._provided[key] = value
 
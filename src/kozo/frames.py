@@ -0,0 +1,237 @@
+import struct
+import time
+import zlib
+from kozo import KozoError, kozoConfig
+
+# Frame types, sent as the magic header of each frame. All frame types have the same length.
+FRAME_MESSAGE = b'KOZOMSG' # A single serialized message
+FRAME_BATCH = b'KOZOBAT' # A sequence of FRAME_MESSAGE frames
+FRAME_HELLO = b'KOZOHLO' # Comma-separated capabilities of the receiving end of a channel, sent by it once the channel is established, and sent back by the connecting end of bidirectional channels
+FRAME_ZLIB = b'KOZOZIP' # Raw deflate data decompressing to complete frames; the deflate stream spans the whole channel
+FRAME_ZLIB_DICT = b'KOZOZDI' # Same as FRAME_ZLIB, with the deflate stream primed with the compression dictionary
+FRAME_HEARTBEAT = b'KOZOHBT' # Empty frame sent on otherwise quiet channels, to show that the sender is alive
+FRAME_SEQUENCED = b'KOZOSEQ' # The sender's stream ID and the sequence number in that stream of the FRAME_MESSAGE frame that follows it, sent separately so that message frames shared between recipients are not copied
+FRAME_ACK = b'KOZOACK' # A stream ID and the sequence number of the last message received in order from that stream, acknowledging it and all messages before it
+_frameTypes = frozenset((FRAME_MESSAGE, FRAME_BATCH, FRAME_HELLO, FRAME_ZLIB, FRAME_ZLIB_DICT, FRAME_HEARTBEAT, FRAME_SEQUENCED, FRAME_ACK))
+_frameTypeLength = len(FRAME_MESSAGE)
+_frameHeaderLength = _frameTypeLength + struct.calcsize('I')
+_sequenceFormat = struct.Struct('QQ') # Stream ID, sequence number
+
+def getFrameHeaderLength():
+	return _frameHeaderLength
+
+def encodeFrameHeader(length, frameType=FRAME_MESSAGE):
+	return frameType + struct.pack('I', length)
+
+def decodeFrameHeader(bytes):
+	"""Returns a (frame type, payload length) tuple for the given frame header, or None if the header is invalid."""
+	frameType = bytes[:_frameTypeLength]
+	if isinstance(frameType, memoryview):
+		frameType = frameType.tobytes()
+	if frameType not in _frameTypes:
+		return None
+	return frameType, struct.unpack_from('I', bytes, _frameTypeLength)[0]
+
+_heartbeatFrame = encodeFrameHeader(0, FRAME_HEARTBEAT)
+def encodeHeartbeatFrame():
+	return _heartbeatFrame
+
+def encodeSequencedFrame(stream, sequence):
+	"""Returns the FRAME_SEQUENCED frame numbering the FRAME_MESSAGE frame to be sent right after it."""
+	return encodeFrameHeader(_sequenceFormat.size, FRAME_SEQUENCED) + _sequenceFormat.pack(stream, sequence)
+
+def decodeSequencedFrame(payload):
+	"""Returns the (stream ID, sequence number) of the given FRAME_SEQUENCED frame payload."""
+	return _sequenceFormat.unpack_from(payload)
+
+def encodeAckFrame(stream, sequence):
+	return encodeFrameHeader(_sequenceFormat.size, FRAME_ACK) + _sequenceFormat.pack(stream, sequence)
+
+def decodeAckFrame(payload):
+	"""Returns the (stream ID, sequence number) acknowledged by the given FRAME_ACK frame payload."""
+	return _sequenceFormat.unpack_from(payload)
+
+def encodeBatchFrame(frames):
+	"""Wraps the given FRAME_MESSAGE, FRAME_SEQUENCED and FRAME_ACK frames into a single FRAME_BATCH frame."""
+	return b''.join([encodeFrameHeader(sum(len(frame) for frame in frames), FRAME_BATCH)] + frames)
+
+def _splitFrames(data, allowedTypes):
+	"""Yields the (frame type, payload) of the complete frames making up the given buffer."""
+	offset = 0
+	while offset < len(data):
+		header = decodeFrameHeader(data[offset:offset + _frameHeaderLength])
+		if header is None or header[0] not in allowedTypes or offset + _frameHeaderLength + header[1] > len(data):
+			raise KozoError('Invalid frame within', repr(allowedTypes), 'frame')
+		offset += _frameHeaderLength
+		yield header[0], data[offset:offset + header[1]]
+		offset += header[1]
+
+_compressionDictionary = (None, None) # (Path, contents)
+def _getCompressionDictionary():
+	global _compressionDictionary
+	path = kozoConfig('compressionDictionary')
+	if path is None:
+		return None
+	if _compressionDictionary[0] != path:
+		with open(path, 'rb') as handle:
+			_compressionDictionary = (path, handle.read(-1)[-32 * 1024:]) # Only the last 32 kilobytes fit in the deflate window
+	return _compressionDictionary[1]
+
+def _dictionaryCapability(dictionary):
+	return b'zlibdict:%08x' % (zlib.crc32(dictionary) & 0xffffffff)
+
+def _newCompressor(level, dictionary):
+	compressor = zlib.compressobj(level, zlib.DEFLATED, -zlib.MAX_WBITS)
+	if dictionary is not None:
+		# Python 2's zlib cannot set a preset dictionary. Instead, both ends run the dictionary through their stream and discard the result, which leaves it in the history window.
+		compressor.compress(dictionary)
+		compressor.flush(zlib.Z_SYNC_FLUSH)
+	return compressor
+
+def _newDecompressor(dictionary):
+	decompressor = zlib.decompressobj(-zlib.MAX_WBITS)
+	if dictionary is not None:
+		primer = _newCompressor(zlib.Z_DEFAULT_COMPRESSION, None)
+		decompressor.decompress(primer.compress(dictionary) + primer.flush(zlib.Z_SYNC_FLUSH))
+	return decompressor
+
+def encodeHelloFrame(standbyChannel=False):
+	"""
+	Returns the hello frame advertising what this node supports when receiving on a channel.
+	The connecting end of a standby channel also sends one, with standbyChannel set, so that the receiving end keeps using its current channel until messages arrive over this one.
+	"""
+	if standbyChannel:
+		return encodeFrameHeader(len(b'standbychannel'), FRAME_HELLO) + b'standbychannel'
+	from .messages import getCompactCapability # messages depends on this module
+	capabilities = [b'zlib', b'heartbeat', b'standby', b'sequence', b'batch', getCompactCapability()]
+	dictionary = _getCompressionDictionary()
+	if dictionary is not None:
+		capabilities.append(_dictionaryCapability(dictionary))
+	if kozoConfig('bidirectionalChannels'):
+		capabilities.append(b'duplex')
+	payload = b','.join(capabilities)
+	return encodeFrameHeader(len(payload), FRAME_HELLO) + payload
+
+def decodeHelloFrame(payload):
+	"""Returns the set of capabilities advertised in the given hello frame payload."""
+	if isinstance(payload, memoryview):
+		payload = payload.tobytes()
+	return frozenset(payload.split(b','))
+
+class FrameReader(object):
+	"""
+	Reads frames from a channel into a reusable buffer.
+	Each read fills as much of the buffer as the channel has available, and returns the frames that are now complete.
+	Batch and compressed frames are unpacked into the frames they contain.
+	Payloads are memoryview slices of the buffer; they are only valid until the next call to read().
+	The buffer grows to fit frames larger than it, and shrinks back once they have been consumed.
+	"""
+	def __init__(self, channel, bufferSize):
+		self._channel = channel
+		self._bufferSize = max(_frameHeaderLength, bufferSize)
+		self._buffer = bytearray(self._bufferSize)
+		self._start = 0 # Start of the data that has not been returned yet
+		self._end = 0 # End of the data received so far
+		self._frameStart = None # When the first bytes of the pending frame were received
+		self._decompressor = None
+	def _pendingFrame(self):
+		"""Returns the (frame type, total size) of the frame at the start of the pending data, or (None, None) if its header is not complete yet."""
+		if self._end - self._start < _frameHeaderLength:
+			return None, None
+		header = decodeFrameHeader(memoryview(self._buffer)[self._start:self._start + _frameHeaderLength])
+		if header is None:
+			raise KozoError('Message did not have valid header:', repr(bytes(self._buffer[self._start:self._start + _frameTypeLength])))
+		return header[0], _frameHeaderLength + header[1]
+	def _makeRoom(self, frameSize):
+		pending = self._end - self._start
+		if pending == 0 and len(self._buffer) > self._bufferSize:
+			self._buffer = bytearray(self._bufferSize)
+		elif frameSize > len(self._buffer):
+			# Never resize the buffer in place, as previously-returned slices may still reference it.
+			newBuffer = bytearray(frameSize)
+			newBuffer[:pending] = self._buffer[self._start:self._end]
+			self._buffer = newBuffer
+		elif self._start and (frameSize or _frameHeaderLength) > len(self._buffer) - self._start:
+			self._buffer[:pending] = self._buffer[self._start:self._end]
+		else:
+			return
+		self._start, self._end = 0, pending
+	def _unpackFrame(self, frameType, payload, frames):
+		if frameType == FRAME_BATCH:
+			frames.extend(_splitFrames(payload, (FRAME_MESSAGE, FRAME_SEQUENCED, FRAME_ACK)))
+		elif frameType in (FRAME_ZLIB, FRAME_ZLIB_DICT):
+			if self._decompressor is None:
+				self._decompressor = _newDecompressor(_getCompressionDictionary() if frameType == FRAME_ZLIB_DICT else None)
+			for innerType, innerPayload in _splitFrames(memoryview(self._decompressor.decompress(payload.tobytes())), (FRAME_MESSAGE, FRAME_BATCH, FRAME_HEARTBEAT, FRAME_SEQUENCED, FRAME_ACK)):
+				self._unpackFrame(innerType, innerPayload, frames)
+		else:
+			frames.append((frameType, payload))
+	def read(self, timeout):
+		"""
+		Reads from the channel once and returns the list of (frame type, payload) tuples of the frames completed by that read (possibly empty).
+		Returns None if the channel timed out or closed, or if a frame took too long to arrive.
+		"""
+		_, frameSize = self._pendingFrame()
+		if self._start != self._end and time.time() > self._frameStart + timeout * (1 + (frameSize or 0) // self._bufferSize):
+			return None
+		self._makeRoom(frameSize)
+		received = self._channel.wrapReceiveInto(memoryview(self._buffer)[self._end:], timeout)
+		if not received:
+			return None
+		newFrame = self._start == self._end
+		self._end += received
+		frames = []
+		view = memoryview(self._buffer)
+		frameType, frameSize = self._pendingFrame()
+		while frameSize is not None and self._end - self._start >= frameSize:
+			self._unpackFrame(frameType, view[self._start + _frameHeaderLength:self._start + frameSize], frames)
+			self._start += frameSize
+			newFrame = True
+			frameType, frameSize = self._pendingFrame()
+		if self._start == self._end:
+			self._start = self._end = 0
+		elif newFrame:
+			self._frameStart = time.time()
+		return frames
+
+class FrameWriter(object):
+	"""
+	Writes frames to a channel.
+	If compression is enabled and the remote end advertised support for it, writes of at least compressionMinSize bytes are compressed.
+	"""
+	def __init__(self, channel, remoteCapabilities=frozenset()):
+		self._channel = channel
+		self._remoteCapabilities = remoteCapabilities
+		self._compressor = None
+		level = kozoConfig('compressionLevel')
+		if level and b'zlib' in remoteCapabilities:
+			dictionary = _getCompressionDictionary()
+			if dictionary is not None and _dictionaryCapability(dictionary) in remoteCapabilities:
+				self._compressedType = FRAME_ZLIB_DICT
+			else:
+				dictionary = None
+				self._compressedType = FRAME_ZLIB
+			self._compressor = _newCompressor(level, dictionary)
+	def getChannel(self):
+		return self._channel
+	def isCompressing(self):
+		return self._compressor is not None
+	def canSendHeartbeatFrames(self):
+		"""Returns whether the remote end understands FRAME_HEARTBEAT; if not, heartbeats must be sent as Heartbeat messages."""
+		return b'heartbeat' in self._remoteCapabilities
+	def canSendCompactMessages(self):
+		"""Returns whether the remote end uses the same compact serializer tables as we do; if not, messages must be sent without the compact serializer."""
+		from .messages import getCompactCapability
+		return getCompactCapability() in self._remoteCapabilities
+	def canSendBatchFrames(self):
+		"""Returns whether the remote end understands FRAME_BATCH; if not, frames must be sent one by one."""
+		return b'batch' in self._remoteCapabilities
+	def canSendSequencedFrames(self):
+		"""Returns whether the remote end understands FRAME_SEQUENCED and FRAME_ACK, and acknowledges the messages it receives."""
+		return b'sequence' in self._remoteCapabilities
+	def write(self, data):
+		"""Writes the given frames, and returns whether they were entirely written."""
+		if self._compressor is not None and len(data) >= kozoConfig('compressionMinSize'):
+			compressed = self._compressor.compress(data) + self._compressor.flush(zlib.Z_SYNC_FLUSH)
+			data = encodeFrameHeader(len(compressed), self._compressedType) + compressed
+		return self._channel.wrapSendAll(data)
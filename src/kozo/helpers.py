@@ -1,6 +1,10 @@
 import collections
+import heapq
 import imp
+import itertools
+import math
 import os
+import Queue
 import random
 import sys
 import time
@@ -31,60 +35,390 @@ def rpio():
 
 class RollingQueue(object):
 	"""
-	A thread-safe, interruptible FIFO queue where pushing elements when full causes the oldest elements to be dropped.
+	A thread-safe, interruptible queue where pushing elements when full causes the oldest elements of the lowest priority to be dropped.
 	Limits by both maximum length (number of elements) and maximum size (memory used by elements).
 	Note that the queue will still accept one larger than the maximum size, in which case all other elements will be dropped from the queue.
+	Pushers may instead wait for room to free up, and the queue counts how many elements it dropped.
+	Elements of the same priority are popped in FIFO order. Across priorities, scheduling is either:
+		'strict': Elements of higher priorities are always popped first.
+		'weighted': Each priority with queued elements gets popped in turn, up to as many times in a row as its rank among the priorities used so far (1 for the lowest one).
 	"""
-	def __init__(self, maxLength=None, maxSize=None):
+	def __init__(self, maxLength=None, maxSize=None, scheduling='strict'):
+		if scheduling not in ('strict', 'weighted'):
+			raise ValueError('Invalid queue scheduling: ' + repr(scheduling))
 		self._maxLength = None if maxLength is None else max(1, maxLength)
 		self._maxSize = None if maxSize is None else max(1, maxSize)
+		self._weighted = scheduling == 'weighted'
 		self._currentSize = 0
-		self._deque = collections.deque(maxlen=self._maxLength)
-		self._condition = threading.Condition()
+		self._length = 0
+		self._deques = {} # Priority -> deque of (element, size), oldest first
+		self._priorities = [] # Priorities that have a deque, highest first
+		self._credits = {} # Priority -> number of elements it may still get popped before other priorities get their turn again
+		self._lock = threading.Lock()
+		self._condition = threading.Condition(self._lock) # Notified when elements are pushed
+		self._roomCondition = threading.Condition(self._lock) # Notified when elements are popped
+		self._waiting = 0 # Number of threads waiting for elements
+		self._waitingForRoom = 0 # Number of threads waiting for room
+		self._dropped = 0
 		self._interrupted = False
 	def isEmpty(self):
 		return len(self) == 0
 	def isFull(self):
 		return self._maxLength is not None and len(self) == self._maxLength
 	def __len__(self):
-		with self._condition:
-			return len(self._deque)
+		# Reading an int attribute is atomic, so there's no need to take the lock just to peek at the length.
+		return self._length
 	def size(self):
-		with self._condition:
-			return self._currentSize
+		return self._currentSize
+	def getFill(self):
+		"""Returns how full the queue is, as the largest fraction of its length and size limits currently used."""
+		fill = 0.0
+		if self._maxLength is not None:
+			fill = float(self._length) / self._maxLength
+		if self._maxSize is not None:
+			fill = max(fill, float(self._currentSize) / self._maxSize)
+		return fill
+	def getDroppedCount(self):
+		"""Returns how many elements were dropped to make room for newer ones since the queue was created."""
+		return self._dropped
 	def interrupt(self):
-		with self._condition:
+		with self._lock:
 			self._interrupted = True
 			self._condition.notifyAll()
-	def push(self, item, itemSize=0):
+			self._roomCondition.notifyAll()
+	def _isOverLimits(self):
+		return (self._maxLength is not None and self._length > self._maxLength) or (self._maxSize is not None and self._currentSize > self._maxSize and self._length > 1)
+	def hasRoomFor(self, itemSize):
+		"""Returns whether an element of the given size could be pushed without dropping any other."""
+		return (self._maxLength is None or self._length < self._maxLength) and (self._maxSize is None or self._currentSize + itemSize <= self._maxSize or not self._length)
+	def push(self, item, itemSize=0, priority=0, timeout=0):
+		"""
+		Pushes the given element, dropping the oldest elements of the lowest priority if the queue is over its limits.
+		If it is full, first waits up to timeout seconds (forever if None) for enough elements to be popped to fit this one.
+		Returns the number of elements dropped, possibly including this one if it was of the lowest priority.
+		"""
 		if itemSize is None:
 			itemSize = 0
-		with self._condition:
+		with self._lock:
+			deadline = None if timeout is None else time.time() + timeout
+			while not self.hasRoomFor(itemSize) and not self._interrupted:
+				if deadline is not None:
+					timeout = deadline - time.time()
+					if timeout <= 0:
+						break
+				self._waitingForRoom += 1
+				try:
+					self._roomCondition.wait(timeout)
+				finally:
+					self._waitingForRoom -= 1
+			dropped = 0
+			if priority not in self._deques:
+				self._deques[priority] = collections.deque()
+				self._priorities = sorted(self._deques, reverse=True)
+			self._deques[priority].append((item, itemSize))
+			self._length += 1
 			self._currentSize += itemSize
-			while ((self._maxSize is not None and self._currentSize > self._maxSize) or
-			       (self._maxLength is not None and len(self._deque) >= self._maxLength)):
-				_, size = self._deque.pop()
-				self._currentSize -= size
-			self._deque.appendleft((item, itemSize))
-			self._condition.notifyAll()
-	def popWithSize(self, blocking=True, timeout=None):
-		with self._condition:
-			while not len(self._deque):
-				if not blocking or self._interrupted:
-					return None, None
+			for lowest in reversed(self._priorities):
+				queue = self._deques[lowest]
+				while queue and self._isOverLimits():
+					_, size = queue.popleft()
+					self._length -= 1
+					self._currentSize -= size
+					dropped += 1
+			self._dropped += dropped
+			if self._waiting:
+				self._condition.notify()
+			return dropped
+	def _nextPriority(self):
+		"""Returns the priority to pop an element from. The queue must not be empty."""
+		if self._weighted:
+			for priority in self._priorities:
+				if self._deques[priority] and self._credits.get(priority, 0) > 0:
+					return priority
+			# Every priority with queued elements has had its turn; start a new round.
+			self._credits = dict((priority, len(self._priorities) - rank) for rank, priority in enumerate(self._priorities))
+		for priority in self._priorities:
+			if self._deques[priority]:
+				return priority
+	def _waitForElements(self, blocking, timeout):
+		"""Waits until the queue has elements. Returns False if it doesn't have any by the timeout, or if the queue was interrupted. Must be called with the lock held."""
+		deadline = None if timeout is None else time.time() + timeout
+		while not self._length:
+			if not blocking or self._interrupted:
+				return False
+			if deadline is not None:
+				timeout = deadline - time.time()
+				if timeout <= 0:
+					return False
+			self._waiting += 1
+			try:
 				self._condition.wait(timeout)
-			element, size = self._deque.pop()
-			self._currentSize -= size
-			return element, size
+			finally:
+				self._waiting -= 1
+		return True
+	def _popElement(self):
+		"""Pops the next (element, size) tuple. The queue must not be empty, and the lock must be held."""
+		priority = self._nextPriority()
+		if self._weighted:
+			self._credits[priority] -= 1
+		element, size = self._deques[priority].popleft()
+		self._length -= 1
+		self._currentSize -= size
+		return element, size
+	def _notifyRoom(self):
+		if self._waitingForRoom:
+			self._roomCondition.notifyAll()
+	def popWithSize(self, blocking=True, timeout=None):
+		with self._lock:
+			if not self._waitForElements(blocking, timeout):
+				return None, None
+			element = self._popElement()
+			self._notifyRoom()
+			return element
 	def pop(self, blocking=True, timeout=None):
 		return self.popWithSize(blocking, timeout)[0]
+	def popMany(self, maxItems=None, maxBytes=None, timeout=0):
+		"""
+		Pops up to maxItems elements, in the order pop() would return them, under a single lock acquisition.
+		Stops before the element that would bring the total size over maxBytes, but always pops at least one element if there is any.
+		Waits up to timeout seconds (forever if None) for the first element. Returns the list of popped elements, possibly empty.
+		"""
+		with self._lock:
+			if not self._waitForElements(timeout is None or timeout > 0, timeout):
+				return []
+			elements = []
+			totalSize = 0
+			while self._length and (maxItems is None or len(elements) < maxItems):
+				if maxBytes is not None and elements:
+					priority = self._nextPriority()
+					if totalSize + self._deques[priority][0][1] > maxBytes:
+						break
+				element, size = self._popElement()
+				elements.append(element)
+				totalSize += size
+			self._notifyRoom()
+			return elements
 	def purge(self, predicate):
 		"""Purge all elements from the queue that don't match the given predicate."""
-		with self._condition:
-			elements = []
-			while not self.isEmpty():
-				element, size = self.popWithSize()
-				if predicate(element):
-					elements.append((element, size))
-			for element, size in elements:
-				self.push(element, size)
+		with self._lock:
+			for priority, queue in self._deques.items():
+				kept = collections.deque((element, size) for element, size in queue if predicate(element))
+				self._length -= len(queue) - len(kept)
+				self._currentSize -= sum(size for _, size in queue) - sum(size for _, size in kept)
+				self._deques[priority] = kept
+			self._notifyRoom()
+
+class WorkerPool(object):
+	"""
+	A fixed number of daemon threads running submitted functions in submission order.
+	Functions should handle their own exceptions; exceptions that escape them are logged and otherwise ignored.
+	"""
+	def __init__(self, numWorkers, name='Worker'):
+		self._queue = Queue.Queue()
+		self._workers = []
+		for i in xrange(max(1, numWorkers)):
+			worker = threading.Thread(target=self._work, name='%s %d' % (name, i))
+			worker.daemon = True
+			self._workers.append(worker)
+	def start(self):
+		for worker in self._workers:
+			worker.start()
+	def submit(self, function, *args):
+		self._queue.put((function, args))
+	def _work(self):
+		while True:
+			function, args = self._queue.get()
+			try:
+				function(*args)
+			except BaseException as e:
+				from .log import warn
+				warn('Worker function', function, 'failed', e)
+
+class _Timer(object):
+	__slots__ = ('name', 'function', 'interval', 'cancelled', 'scheduled')
+	def __init__(self, name, function, interval):
+		self.name = name
+		self.function = function
+		self.interval = interval
+		self.cancelled = False
+		self.scheduled = False # Whether the timer is in the heap
+
+class Timers(object):
+	"""
+	A thread-safe set of functions to call at given times, run by a single thread calling runDue().
+	Timer functions run on that thread, so they must not block.
+	Cancelled timers are left in the heap until they come up, unless they make up more than half of it, in which case it is rebuilt without them.
+	"""
+	COMPACT_MIN_SIZE = 64
+	def __init__(self):
+		self._lock = threading.Lock()
+		self._heap = [] # (time, sequence number, _Timer)
+		self._cancelled = 0 # Number of cancelled timers in the heap
+		self._sequence = itertools.count()
+		self._onEarlier = None
+	def setEarlierCallback(self, callback):
+		"""Sets a function to call whenever a timer becomes the next one due, so that the thread running the timers can wake up for it."""
+		self._onEarlier = callback
+	def _push(self, when, timer):
+		with self._lock:
+			heapq.heappush(self._heap, (when, self._sequence.next(), timer))
+			timer.scheduled = True
+			earlier = self._heap[0][2] is timer
+		if earlier and self._onEarlier is not None:
+			self._onEarlier()
+	def callLater(self, delay, function, name='timer'):
+		"""Calls the given function once, after the given delay. Returns a handle that can be passed to cancel()."""
+		timer = _Timer(name, function, None)
+		self._push(time.time() + delay, timer)
+		return timer
+	def callEvery(self, interval, function, name='timer', firstDelay=None):
+		"""Calls the given function every interval seconds, the first time after firstDelay seconds (a random fraction of the interval by default). Returns a handle that can be passed to cancel()."""
+		timer = _Timer(name, function, interval)
+		self._push(time.time() + (random.uniform(0, interval) if firstDelay is None else firstDelay), timer)
+		return timer
+	def cancel(self, timer):
+		with self._lock:
+			if timer.cancelled:
+				return
+			timer.cancelled = True
+			if not timer.scheduled:
+				return
+			self._cancelled += 1
+			if len(self._heap) >= self.COMPACT_MIN_SIZE and 2 * self._cancelled > len(self._heap):
+				for _, _, cancelledTimer in self._heap:
+					if cancelledTimer.cancelled:
+						cancelledTimer.scheduled = False
+				self._heap = [entry for entry in self._heap if not entry[2].cancelled]
+				heapq.heapify(self._heap)
+				self._cancelled = 0
+	def _pop(self):
+		"""Pops the next timer from the heap. The lock must be held."""
+		when, _, timer = heapq.heappop(self._heap)
+		timer.scheduled = False
+		if timer.cancelled:
+			self._cancelled -= 1
+		return when, timer
+	def getNextTime(self):
+		"""Returns when the next timer is due, or None if there are none."""
+		with self._lock:
+			while self._heap and self._heap[0][2].cancelled:
+				self._pop()
+			return self._heap[0][0] if self._heap else None
+	def runDue(self):
+		"""Calls the functions of all timers that are due."""
+		while True:
+			now = time.time()
+			with self._lock:
+				if not self._heap or self._heap[0][0] > now:
+					return
+				when, timer = self._pop()
+			if timer.cancelled:
+				continue
+			try:
+				timer.function()
+			except BaseException as e:
+				from .log import warn
+				warn('Timer', timer.name, 'failed', e)
+			if timer.interval is not None and not timer.cancelled:
+				self._push(max(when + timer.interval, now), timer)
+	def getStats(self):
+		"""Returns a dictionary mapping timer names to a (number of pending timers, seconds until the next one is due) tuple. Cancelled timers are not counted."""
+		now = time.time()
+		stats = {}
+		with self._lock:
+			for when, _, timer in self._heap:
+				if not timer.cancelled:
+					count, nextDue = stats.get(timer.name, (0, None))
+					stats[timer.name] = (count + 1, when - now if nextDue is None else min(nextDue, when - now))
+		return stats
+
+class PhiAccrualDetector(object):
+	"""
+	Phi accrual failure detector, as described by Hayashibara et al.
+	Keeps a window of the intervals between arrivals, and estimates how unlikely the current silence is given their distribution.
+	The resulting suspicion level (phi) is -log10 of the probability that a sign of life would still arrive after such a long silence.
+	If given, expectedInterval seeds the history, so that silences can be judged before any interval has been observed.
+	"""
+	def __init__(self, windowSize=100, minStdDev=0.1, acceptablePause=0, expectedInterval=None):
+		self._intervals = collections.deque(maxlen=windowSize)
+		if expectedInterval is not None:
+			self._intervals.extend((expectedInterval * 0.75, expectedInterval * 1.25))
+		self._minStdDev = minStdDev
+		self._acceptablePause = acceptablePause
+		self._lastArrival = None
+	def restart(self):
+		"""Forgets the last arrival, so that the time until the next one is not counted as an interval. The interval history is kept."""
+		self._lastArrival = None
+	def arrived(self, now=None):
+		if now is None:
+			now = time.time()
+		if self._lastArrival is not None:
+			self._intervals.append(now - self._lastArrival)
+		self._lastArrival = now
+	def phi(self, now=None):
+		"""Returns the current suspicion level, or 0 if there is not enough history yet."""
+		lastArrival = self._lastArrival
+		intervals = list(self._intervals)
+		if lastArrival is None or not intervals:
+			return 0.0
+		if now is None:
+			now = time.time()
+		mean = float(sum(intervals)) / len(intervals)
+		stdDev = max(self._minStdDev, math.sqrt(sum((i - mean) ** 2 for i in intervals) / len(intervals)))
+		# Logistic approximation of the normal distribution's cumulative distribution function.
+		y = max(-10.0, (now - lastArrival - mean - self._acceptablePause) / stdDev) # Clamped to avoid overflows; phi is 0 there anyway
+		e = math.exp(-y * (1.5976 + 0.070566 * y * y))
+		if y > 0:
+			return -math.log10(max(e / (1.0 + e), 1e-300))
+		return -math.log10(1.0 - 1.0 / (1.0 + e))
+
+class LinkStats(object):
+	"""
+	Keeps track of how connecting over links (such as pairs of transports, or addresses) went recently.
+	Links are ranked by expected connection time: the average handshake time plus round-trip time, doubled for each recent failure.
+	Failures are forgotten over time, counting half as much every halfLife seconds, so that links which failed get tried again eventually.
+	"""
+	def __init__(self, halfLife=600, smoothing=0.25):
+		self._halfLife = halfLife
+		self._smoothing = smoothing
+		self._lock = threading.Lock()
+		self._links = {} # Key -> [average handshake time, average round-trip time, failures, time of the last failure]
+	def _getLink(self, key):
+		if key not in self._links:
+			self._links[key] = [None, None, 0.0, 0]
+		return self._links[key]
+	def _average(self, average, sample):
+		if average is None:
+			return sample
+		return average + self._smoothing * (sample - average)
+	def _getFailures(self, link, now):
+		return link[2] * 0.5 ** ((now - link[3]) / self._halfLife)
+	def succeeded(self, key, handshakeTime, roundTripTime=None):
+		with self._lock:
+			link = self._getLink(key)
+			link[0] = self._average(link[0], handshakeTime)
+			if roundTripTime is not None:
+				link[1] = self._average(link[1], roundTripTime)
+	def failed(self, key):
+		now = time.time()
+		with self._lock:
+			link = self._getLink(key)
+			link[2] = self._getFailures(link, now) + 1
+			link[3] = now
+	def getExpectedTime(self, key, defaultTime=1.0):
+		"""Returns how long connecting over the given link is expected to take, or defaultTime if it was never used successfully, doubled for each recent failure."""
+		now = time.time()
+		with self._lock:
+			link = self._links.get(key)
+			if link is None:
+				return defaultTime
+			expected = defaultTime if link[0] is None else link[0] + (link[1] or 0)
+			return expected * 2 ** self._getFailures(link, now)
+	def sort(self, items, key=lambda item: item, defaultTime=lambda item: 1.0):
+		"""Returns the given items sorted by the expected connection time of their link. Items with the same expected time keep their order."""
+		return sorted(items, key=lambda item: self.getExpectedTime(key(item), defaultTime(item)))
+	def getStats(self):
+		"""Returns a dictionary mapping link keys to an (average handshake time, average round-trip time, recent failures) tuple."""
+		now = time.time()
+		with self._lock:
+			return dict((key, (link[0], link[1], self._getFailures(link, now))) for key, link in self._links.items())
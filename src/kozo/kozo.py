@@ -7,6 +7,10 @@ class KozoStopError(KozoError):
 from .confsys import *
 
 class Role(Configurable):
+	# Statuses returned by sendEvent, sendOrder and sendLog.
+	SEND_QUEUED = 'queued' # The message was queued for all its recipients.
+	SEND_DROPPED = 'dropped' # The queue of at least one recipient was full, so this message or older ones were dropped from it.
+
 	def __init__(self, name, nodeName, providedConfig):
 		roleConfig = self.__class__._roleConfig.copy()
 		for key, default in self.__class__._roleConfig.iteritems():
@@ -29,12 +33,21 @@ class Role(Configurable):
 		self._node = node
 	def setControllingThread(self, controllingThread):
 		self._controllingThread = controllingThread
+	def getSubscriptions(self):
+		"""Returns a list of kozo.subscriptions.Subscription describing the messages this role may be interested in, or None to be asked isInterestedIn() about every message.
+		Subscriptions are compiled into an index when the runtime starts; they may depend on the role's configuration, but not on anything set up by localInit().
+		If this returns a list, isInterestedIn() is only called for matching messages, and only if overridden; otherwise, all matching messages are considered interesting."""
+		return None
 	def isInterestedIn(self, message):
 		return False
 	def getRateControl(self):
 		return None
 	def getMessageRateControlOverride(self):
 		return None
+	def onBackpressure(self, nodes):
+		"""Called after sending a message if the outgoing queues to the given nodes are filled above outgoingQueueHighWatermark.
+		Roles producing messages faster than these nodes can take them may slow down here, for instance with sleep()."""
+		pass
 	def sleep(self, seconds):
 		if self._controllingThread is not None:
 			self._controllingThread.sleep(seconds)
@@ -46,6 +59,8 @@ class Role(Configurable):
 		if self['messageQueueSize'] is not None:
 			return self['messageQueueSize']
 		return 4 * 1024 * 1024 # 4 megabytes
+	def runsInOwnProcess(self):
+		return bool(self['ownProcess'])
 	def getMessage(self, timeout=None):
 		"""Get a message from our queue.
 
@@ -57,18 +72,26 @@ class Role(Configurable):
 		"""
 		if self._controllingThread is not None:
 			return self._controllingThread.getMessage(timeout)
-	def sendEvent(self, eventType, channel=None, data={}):
+	def sendEvent(self, eventType, channel=None, data={}, timeout=0):
+		"""Sends an Event. Returns SEND_QUEUED or SEND_DROPPED.
+		If the queue to a recipient is full, waits up to timeout seconds (forever if None) for it to have room before dropping older messages.
+		With the eventloop runtime mode, the timeout is ignored and older messages are dropped right away."""
 		from .messages import Event
 		if self._controllingThread is not None:
-			self._controllingThread.sendMessage(Event(self, eventType, channel, data))
-	def sendOrder(self, orderType, channel=None, data={}):
+			return self._controllingThread.sendMessage(Event(self, eventType, channel, data), timeout)
+	def sendOrder(self, orderType, channel=None, data={}, timeout=0):
+		"""Sends an Order. Returns SEND_QUEUED or SEND_DROPPED; see sendEvent."""
 		from .messages import Order
 		if self._controllingThread is not None:
-			self._controllingThread.sendMessage(Order(self, orderType, channel, data))
-	def sendLog(self, *logMessage):
+			return self._controllingThread.sendMessage(Order(self, orderType, channel, data), timeout)
+	def sendLog(self, *logMessage, **kwargs):
+		"""Sends a Log. Returns SEND_QUEUED or SEND_DROPPED; accepts a timeout keyword argument, as in sendEvent."""
 		from .messages import Log
+		timeout = kwargs.pop('timeout', 0)
+		if kwargs:
+			raise TypeError('sendLog() got an unexpected keyword argument %r' % sorted(kwargs)[0])
 		if self._controllingThread is not None:
-			self._controllingThread.sendMessage(Log(self, *logMessage))
+			return self._controllingThread.sendMessage(Log(self, *logMessage), timeout)
 	def info(self, *msg, **kwargs):
 		from .log import infoRole
 		return infoRole(self, *msg, **kwargs)
@@ -84,11 +107,17 @@ class Role(Configurable):
 		pass
 	def getStorage(self):
 		from .messages import RoleStorage
+		from .runtime import RoleProcessClient
+		if isinstance(self._controllingThread, RoleProcessClient):
+			return self._controllingThread.getStorage()
 		if not self._storage[0]:
 			self._storage = (True, RoleStorage.load(self))
 		return self._storage[1].getRoleStorage()
 	def setStorage(self, storage):
 		from .messages import RoleStorage
+		from .runtime import RoleProcessClient
+		if isinstance(self._controllingThread, RoleProcessClient):
+			return self._controllingThread.setStorage(storage)
 		roleStorage = RoleStorage(self, storage)
 		roleStorage.save()
 		self._storage = (True, roleStorage)
@@ -134,6 +163,8 @@ class Transport(Configurable):
 		pass
 	def bind(self):
 		pass
+	def unbind(self):
+		pass
 	def canAccept(self):
 		return True
 	def accept(self):
@@ -167,11 +198,42 @@ class Channel(object):
 			return self.send(bytes)
 	def send(self, bytes):
 		raise NotImplementedError()
+	def wrapSendAll(self, data):
+		if self._alive:
+			return self.sendAll(data)
+		return False
+	def sendAll(self, data):
+		"""Sends all of the given string or buffer, and returns whether it was entirely sent.
+
+		The default implementation calls send() with successive chunks of at most maxBufferWriteSize bytes, so only the chunk being sent gets copied.
+		"""
+		view = memoryview(data)
+		chunkSize = kozoConfig('maxBufferWriteSize')
+		offset = 0
+		while offset < len(view):
+			sent = self.send(view[offset:offset + chunkSize].tobytes())
+			if not sent:
+				return False
+			offset += sent
+		return True
 	def wrapReceive(self, bytes, timeout):
 		if self._alive:
 			return self.receive(bytes, timeout)
 	def receive(self, bytes, timeout):
 		raise NotImplementedError()
+	def wrapReceiveInto(self, buffer, timeout):
+		if self._alive:
+			return self.receiveInto(buffer, timeout)
+	def receiveInto(self, buffer, timeout):
+		"""Reads into the given writable buffer (such as a memoryview), and returns the number of bytes read. Returns 0 or None on error or timeout."""
+		data = self.receive(len(buffer), timeout)
+		if not data:
+			return None
+		buffer[:len(data)] = data
+		return len(data)
+	def fileno(self):
+		"""Returns a file descriptor that becomes readable when receive() has data to return, or None if the channel has none. Used by the eventloop runtime mode."""
+		return None
 	def __str__(self):
 		return 'Channel<' + self._fromNode.getName() + ' to ' + self._toNode.getName() + '>'
 
@@ -184,6 +246,9 @@ class Node(Configurable):
 		Configurable.__init__(self, 'Node<' + name + '>', providedConfig, {
 			'selfToOthersConnectPolicy': self.CONNECTPOLICY_CONSTANT,
 			'othersToSelfConnectPolicy': self.CONNECTPOLICY_CONSTANT,
+			'warmStandby': False,
+			'spool': False,
+			'relay': False,
 			'roleStorage': None,
 			'overrideMainConfiguration': {},
 		}, ['publicKey', 'privateKey', 'roles', 'transports'])
@@ -203,6 +268,9 @@ class Node(Configurable):
 		self._othersToSelfConnectPolicy = self['othersToSelfConnectPolicy']
 		if self._othersToSelfConnectPolicy not in self.CONNECTPOLICIES:
 			raise KozoError('Invalid othersToSelfConnectPolicy on node', self.getName())
+		self._warmStandby = self['warmStandby']
+		self._spool = self['spool']
+		self._relay = self['relay']
 		kozoSystem().addNode(self)
 	def getName(self):
 		return self._name
@@ -228,6 +296,12 @@ class Node(Configurable):
 		return self._selfToOthersConnectPolicy
 	def getOthersToSelfConnectPolicy(self):
 		return self._othersToSelfConnectPolicy
+	def getWarmStandby(self):
+		return self._warmStandby
+	def getSpool(self):
+		return self._spool
+	def isRelay(self):
+		return self._relay
 	def addTransport(self, transport):
 		transport._setNode(self)
 		self._transports.append(transport)
@@ -247,6 +321,7 @@ class KozoSystem(object):
 		self._nodes = []
 		self._nodesByName = {}
 		self._selfNode = None
+		self._subscriptionIndex = None
 	def addNode(self, node):
 		if node.getName() not in self._nodesByName:
 			self._nodes.append(node)
@@ -259,6 +334,12 @@ class KozoSystem(object):
 		return filter(func, self.getNodes())
 	def getSelfNode(self):
 		return self._selfNode
+	def getSubscriptionIndex(self):
+		"""Returns the index of the subscriptions of all roles of all nodes."""
+		if self._subscriptionIndex is None:
+			from .subscriptions import SubscriptionIndex
+			self._subscriptionIndex = SubscriptionIndex([role for node in self.getNodes() for role in node.getRoles()])
+		return self._subscriptionIndex
 	def kill(self):
 		for node in self.getNodes():
 			node._kill()
@@ -287,9 +368,40 @@ _kozoConfig = None
 _kozoConfigDefault = {
 	'heartbeat': 10,
 	'connectionRetry': 60,
+	'connectionBackoff': 1,
+	'connectionStagger': 2,
+	'connectionRaceDelay': 1,
+	'idleTimeout': 300,
+	'bidirectionalChannels': False,
+	'topology': 'mesh',
+	'relayHopLimit': 4,
+	'relayAdvertiseInterval': 30,
+	'broadcastFanOut': 0,
 	'outgoingQueueLength': 128,
 	'outgoingQueueSize': 4 * 1024 * 1024, # 4 megabytes
+	'messagePriorities': {'Heartbeat': 3, 'Reachability': 3, 'Order': 2, 'Event': 1, 'Log': 0},
+	'queueScheduling': 'weighted',
+	'outgoingQueueHighWatermark': 0.8,
+	'retransmitWindow': 0,
+	'spoolPath': None,
+	'spoolMaxSize': 64 * 1024 * 1024, # 64 megabytes
+	'spoolMaxAge': 7 * 24 * 3600, # One week
+	'spoolSegmentSize': 1024 * 1024, # 1 megabyte
 	'maxBufferReadSize': 64 * 1024, # 64 kilobytes
+	'maxBufferWriteSize': 64 * 1024, # 64 kilobytes
+	'batchMaxMessages': 128,
+	'batchMaxSize': 64 * 1024, # 64 kilobytes
+	'batchLinger': 0,
+	'roleBatchMessages': 1,
+	'compressionLevel': 0,
+	'compressionMinSize': 256,
+	'compressionDictionary': None,
+	'negotiationTimeout': 5,
+	'failureDetectorThreshold': 8,
+	'runtimeMode': 'threads',
+	'eventLoopWorkers': 8,
+	'connectionWorkers': 4,
+	'msgpackMaxSize': 32 * 1024, # 32 kilobytes
 	'cipher': 'aes256-ctr',
 	'hmac': 'hmac-sha1',
 	'rolePath': '',
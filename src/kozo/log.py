@@ -26,6 +26,13 @@ class _logThread(_threading.Thread):
 _logThreadInstance = _logThread()
 _logThreadInstance.start()
 
+def restartLogThread():
+	"""Starts logging again in a forked process, which has none of its parent's threads. The queue is replaced too, in case the fork happened while it was locked."""
+	global _logQueue, _logThreadInstance
+	_logQueue = _queue.Queue()
+	_logThreadInstance = _logThread()
+	_logThreadInstance.start()
+
 def _log(level, *msg, **kwargs):
 	newMsg = []
 	for m in msg:
@@ -2,8 +2,10 @@ import os
 import struct
 import time
 import itertools
-from kozo import KozoError, kozoSystem, Node
+import zlib
+from kozo import KozoError, kozoSystem, kozoConfig, Node
 from .log import *
+from .frames import getFrameHeaderLength, encodeFrameHeader
 
 _serializers = []
 
@@ -27,9 +29,14 @@ try:
 	import msgpack as _msgpack
 	class _MsgpackSerializer(_Serializer):
 		def pack(self, data):
-			if len(repr(data)) > 32768:
+			try:
+				packed = _msgpack.packb(data)
+			except (TypeError, ValueError, OverflowError):
+				return None # Not representable in msgpack; let the next serializer handle it
+			maxSize = kozoConfig('msgpackMaxSize')
+			if maxSize is not None and len(packed) > maxSize:
 				return None
-			return _msgpack.packb(data)
+			return packed
 		def unpack(self, data):
 			return _msgpack.unpackb(data, use_list=False)
 	_serializers.append(_MsgpackSerializer())
@@ -53,6 +60,196 @@ class _PickleSerializer(_Serializer):
 		return _pickle.loads(data)
 _serializers.append(_PickleSerializer())
 
+class _NameTable(object):
+	"""Bidirectional mapping between a set of names and their index in sorted order."""
+	def __init__(self, names):
+		self._names = sorted(names)
+		self._indexes = dict((name, i) for i, name in enumerate(self._names))
+	def index(self, name):
+		return self._indexes[name]
+	def name(self, index):
+		return self._names[index]
+
+class _LazyData(object):
+	"""Message data that was received but is only decoded once something asks for it."""
+	def __init__(self, encoded, decode):
+		self._encoded = encoded
+		self._decode = decode
+	def getEncoded(self):
+		return self._encoded
+	def decode(self):
+		return self._decode(self._encoded)
+
+def _resolveLazy(container, key):
+	"""Returns container[key], decoding it in place first if it is lazily-decoded data."""
+	value = container[key]
+	if isinstance(value, _LazyData):
+		value = value.decode()
+		container[key] = value
+	return value
+
+class _CompactSerializer(_Serializer):
+	"""
+	Packs the built-in message classes with a fixed field layout instead of a dictionary.
+	Classes are identified by their position in _CLASSES, and node and role names by their index in sorted tables derived from the system configuration.
+	Since these tables change along with the configuration, compact messages are only sent to nodes that advertise the same tables (see getCompactCapability()), and must never be written to disk; see _Message.toStorableFrame().
+	Arbitrary data (event data, order data) is packed last, using the first other serializer that accepts it.
+	On unpacking, that data is left encoded until a role asks for it, so routing a message only costs decoding the fixed fields.
+	Returns None for anything that does not fit the layout, so that the other serializers get a chance.
+	"""
+	_CLASSES = ('Heartbeat', 'Event', 'Order', 'Log') # Class IDs on the wire; only ever append to this
+	_HEADER = '!BHd' # Class ID, sender node index, timestamp
+	_ROLE = '!H' # Role index within the sender node
+	_STRING = '!BH' # String type (one of the constants below), length
+	_STRING_NONE = 0
+	_STRING_BYTES = 1
+	_STRING_UNICODE = 2
+	_DATA = '!B' # Serializer index
+	def __init__(self):
+		self._tables = None
+		self._layouts = {
+			'Heartbeat': ('heartbeat', self._packHeartbeat, self._unpackHeartbeat),
+			'Event': ('role', self._packEvent, self._unpackEvent),
+			'Order': ('role', self._packOrder, self._unpackOrder),
+			'Log': ('role', self._packLog, self._unpackLog),
+		}
+	def _getTables(self):
+		if self._tables is None:
+			roles = {}
+			for node in kozoSystem().getNodes():
+				roles[node.getName()] = _NameTable(role.getName() for role in node.getRoles())
+			self._tables = (
+				_NameTable(node.getName() for node in kozoSystem().getNodes()),
+				roles
+			)
+		return self._tables
+	def getTablesHash(self):
+		"""Returns a hash of the class list and of the node and role tables, which two nodes must share to exchange compact messages."""
+		nodes, roles = self._getTables()
+		description = '\n'.join([','.join(self._CLASSES)] + [name + ':' + ','.join(roles[name]._names) for name in nodes._names])
+		return '%08x' % (zlib.crc32(description) & 0xffffffff)
+	def _packString(self, value):
+		if value is None:
+			return struct.pack(self._STRING, self._STRING_NONE, 0)
+		if type(value) is unicode:
+			value = value.encode('utf8')
+			return struct.pack(self._STRING, self._STRING_UNICODE, len(value)) + value
+		if type(value) is not str:
+			raise TypeError('Not a string: ' + repr(type(value)))
+		return struct.pack(self._STRING, self._STRING_BYTES, len(value)) + value
+	def _unpackString(self, data, offset):
+		stringType, length = struct.unpack_from(self._STRING, data, offset)
+		offset += struct.calcsize(self._STRING)
+		value = data[offset:offset + length]
+		if stringType == self._STRING_NONE:
+			value = None
+		elif stringType == self._STRING_UNICODE:
+			value = value.decode('utf8')
+		elif stringType != self._STRING_BYTES:
+			raise ValueError('Invalid string type: ' + repr(stringType))
+		return value, offset + length
+	def _packData(self, value):
+		if isinstance(value, _LazyData):
+			return value.getEncoded()
+		for i, serializer in enumerate(_serializers):
+			if serializer is not self:
+				serialized = serializer.pack(value)
+				if serialized is not None:
+					return struct.pack(self._DATA, i) + serialized
+		raise ValueError('No serializer can pack data')
+	def _unpackData(self, data, offset):
+		if _serializers[struct.unpack_from(self._DATA, data, offset)[0]] is self:
+			raise ValueError('Nested compact data')
+		return _LazyData(data[offset:], self._decodeData)
+	def _decodeData(self, encoded):
+		serializer = _serializers[struct.unpack_from(self._DATA, encoded)[0]]
+		return serializer.unpack(encoded[struct.calcsize(self._DATA):])
+	def _packRole(self, content):
+		roleContent = content['data']
+		if len(roleContent) != 4:
+			raise ValueError('Unexpected role message fields')
+		return struct.pack(self._ROLE, self._getTables()[1][content['sender']].index(roleContent['fromRole'])) + self._packString(roleContent['channel'])
+	def _unpackRole(self, data, offset, sender, roleMessageType, roleData):
+		roleIndex = struct.unpack_from(self._ROLE, data, offset)[0]
+		channel, offset = self._unpackString(data, offset + struct.calcsize(self._ROLE))
+		return {
+			'roleMessageType': roleMessageType,
+			'fromRole': self._getTables()[1][sender].name(roleIndex),
+			'channel': channel,
+			'roleData': roleData(offset)
+		}
+	def _packHeartbeat(self, content):
+		if content['data'] is not None:
+			raise ValueError('Heartbeat with data')
+		return b''
+	def _unpackHeartbeat(self, data, offset, sender):
+		return None
+	def _packTyped(self, content, roleMessageType, typeKey, dataKey):
+		roleData = content['data']['roleData']
+		if content['data']['roleMessageType'] != roleMessageType or len(roleData) != 2:
+			raise ValueError('Unexpected ' + roleMessageType + ' fields')
+		return self._packRole(content) + self._packString(roleData[typeKey]) + self._packData(roleData[dataKey])
+	def _unpackTyped(self, data, offset, sender, roleMessageType, typeKey, dataKey):
+		def roleData(offset):
+			typeValue, offset = self._unpackString(data, offset)
+			return {typeKey: typeValue, dataKey: self._unpackData(data, offset)}
+		return self._unpackRole(data, offset, sender, roleMessageType, roleData)
+	def _packEvent(self, content):
+		return self._packTyped(content, 'event', 'eventType', 'eventData')
+	def _unpackEvent(self, data, offset, sender):
+		return self._unpackTyped(data, offset, sender, 'event', 'eventType', 'eventData')
+	def _packOrder(self, content):
+		return self._packTyped(content, 'order', 'orderType', 'orderData')
+	def _unpackOrder(self, data, offset, sender):
+		return self._unpackTyped(data, offset, sender, 'order', 'orderType', 'orderData')
+	def _packLog(self, content):
+		roleData = content['data']['roleData']
+		if content['data']['roleMessageType'] != 'log' or len(roleData) != 1:
+			raise ValueError('Unexpected log fields')
+		return self._packRole(content) + self._packString(roleData['message'])
+	def _unpackLog(self, data, offset, sender):
+		return self._unpackRole(data, offset, sender, 'log', lambda offset: {'message': self._unpackString(data, offset)[0]})
+	def pack(self, data):
+		className, content = data
+		if className not in self._layouts:
+			return None
+		messageType, packer, _ = self._layouts[className]
+		try:
+			if content['type'] != messageType or len(content) != 4:
+				return None
+			nodes, _ = self._getTables()
+			return struct.pack(self._HEADER, self._CLASSES.index(className), nodes.index(content['sender']), content['timestamp']) + packer(content)
+		except (KeyError, IndexError, TypeError, ValueError, AttributeError, struct.error):
+			return None
+	def unpack(self, data):
+		try:
+			classIndex, senderIndex, timestamp = struct.unpack_from(self._HEADER, data)
+			nodes, _ = self._getTables()
+			className = self._CLASSES[classIndex]
+			sender = nodes.name(senderIndex)
+			messageType, _, unpacker = self._layouts[className]
+			return (className, {
+				'type': messageType,
+				'timestamp': timestamp,
+				'sender': sender,
+				'data': unpacker(data, struct.calcsize(self._HEADER), sender)
+			})
+		except (KeyError, IndexError, ValueError, UnicodeDecodeError, struct.error):
+			return None
+
+# The compact serializer is preferred, but registered last so that the indexes of the other serializers stay the same on the wire.
+_compactSerializerIndex = len(_serializers)
+_serializers.append(_CompactSerializer())
+_serializerOrder = [_compactSerializerIndex] + range(_compactSerializerIndex)
+
+def getCompactCapability():
+	"""Returns the hello frame capability advertising the compact serializer's tables. Compact frames may only be sent to nodes advertising the same one."""
+	return b'compact:' + _serializers[_compactSerializerIndex].getTablesHash()
+
+def isCompactFrame(frame):
+	"""Returns whether the given message frame uses the compact serializer."""
+	return struct.unpack_from('I', frame, getFrameHeaderLength())[0] == _compactSerializerIndex
+
 _definedMessageClasses = {}
 class _MessageMetaclass(type):
 	def __new__(*args, **kwargs):
@@ -61,6 +258,8 @@ class _MessageMetaclass(type):
 		def newInit(self, *args, **kwargs):
 			if '_kozoMessage_payload' in kwargs:
 				self._content = kwargs['_kozoMessage_payload']
+				self._frame = None
+				self._storableFrame = None
 				self._size = None
 			else:
 				builtClass._kozoMessage_init(self, *args, **kwargs)
@@ -71,16 +270,20 @@ class _MessageMetaclass(type):
 		return builtClass
 
 def decodeMessage(bytes):
+	"""Decodes a message from a frame payload, given either as a string or as a memoryview (as returned by FrameReader)."""
 	indexBytes = struct.calcsize('I')
-	serializerIndex = struct.unpack('I', bytes[:indexBytes])[0]
+	serializerIndex = struct.unpack_from('I', bytes)[0]
 	try:
 		serializer = _serializers[serializerIndex]
 	except IndexError:
 		warn('Received payload with unknown serializer index:', serializerIndex)
 		return None
-	payload = serializer.unpack(bytes[indexBytes:])
+	serialized = bytes[indexBytes:]
+	if isinstance(serialized, memoryview):
+		serialized = serialized.tobytes() # Serializers work on strings, and the memoryview's buffer gets reused
+	payload = serializer.unpack(serialized)
 	if payload is None:
-		warn('Cannot deserialize payload with serializer', serializer, ':', repr(bytes[indexBytes:]))
+		warn('Cannot deserialize payload with serializer', serializer, ':', repr(serialized))
 		return None
 	if type(payload) is not type(()):
 		warn('Received non-tuple payload:', type(payload))
@@ -95,7 +298,37 @@ def decodeMessage(bytes):
 	if type(messageContents) is not type({}):
 		warn('Message content is not a dictionary:', type(messageContents))
 		return None
-	return _definedMessageClasses[messageClass](_kozoMessage_payload=messageContents)
+	message = _definedMessageClasses[messageClass](_kozoMessage_payload=messageContents)
+	message._size = getFrameHeaderLength() + len(bytes)
+	return message
+
+def decodeFramedMessage(frame):
+	"""Decodes a message from a complete frame, as returned by toFrame(). The frame is kept as the message's own, so it is not serialized again."""
+	message = decodeMessage(frame[getFrameHeaderLength():])
+	if message is not None:
+		message._frame = frame
+	return message
+
+_messagePriorities = {} # Message class -> [(class name, priority or None)] of the message classes it derives from, up to the first one with a priority. Not keyed by type, as other nodes choose the types.
+def _getMessagePriority(messageClass, type):
+	priorities = kozoConfig('messagePriorities')
+	chain = _messagePriorities.get(messageClass)
+	if chain is None:
+		chain = []
+		for c in messageClass.__mro__:
+			if _definedMessageClasses.get(c.__name__) is c:
+				chain.append((c.__name__, priorities.get(c.__name__)))
+				if chain[-1][1] is not None:
+					break
+		_messagePriorities[messageClass] = chain
+	for name, priority in chain:
+		if type is not None:
+			typePriority = priorities.get('%s:%s' % (name, type))
+			if typePriority is not None:
+				return typePriority
+		if priority is not None:
+			return priority
+	return 0
 
 class _Message(object):
 	__metaclass__ = _MessageMetaclass
@@ -106,30 +339,89 @@ class _Message(object):
 			'sender': kozoSystem().getSelfNode().getName(),
 			'data': data
 		}
+		self._frame = None
+		self._storableFrame = None
 		self._size = None
 	def getRecipientNodes(self):
 		return kozoSystem().getNodes()
-	def toBytes(self):
+	def _serialize(self, compact=True):
 		message = (self.__class__.__name__, self._content)
-		for i, serializer in enumerate(_serializers):
-			serialized = serializer.pack(message)
+		for i in _serializerOrder:
+			if i == _compactSerializerIndex and not compact:
+				continue
+			if i != _compactSerializerIndex:
+				self._resolveData() # Only the compact serializer can pack data that has not been decoded yet.
+			serialized = _serializers[i].pack(message)
 			if serialized is not None:
 				return struct.pack('I', i) + serialized
 		return None
+	def toFrame(self):
+		"""Returns the framed wire representation of this message (header, length, serializer index, payload).
+
+		The frame is built only once and then shared by every recipient, so messages must not be modified after being sent.
+		"""
+		if self._frame is None:
+			serialized = self._serialize()
+			if serialized is not None:
+				self._frame = encodeFrameHeader(len(serialized)) + serialized
+				self._size = len(self._frame)
+		return self._frame
+	def toStorableFrame(self):
+		"""
+		Returns a frame of this message that does not use the compact serializer, whose tables depend on the system configuration and code version.
+		Use this for frames written to disk, and for nodes that don't share our compact tables. Like toFrame(), it is only built once.
+		"""
+		if self._frame is not None and not isCompactFrame(self._frame):
+			return self._frame
+		if self._storableFrame is None:
+			serialized = self._serialize(False)
+			if serialized is not None:
+				self._storableFrame = encodeFrameHeader(len(serialized)) + serialized
+		return self._storableFrame
+	def toBytes(self):
+		"""Returns the serialized message, possibly compact. Only use this within the node; see toStorableBytes()."""
+		frame = self.toFrame()
+		if frame is None:
+			return None
+		return frame[getFrameHeaderLength():]
+	def toStorableBytes(self):
+		"""Returns the serialized message without the compact serializer, for messages carried by other messages to other nodes."""
+		frame = self.toStorableFrame()
+		if frame is None:
+			return None
+		return frame[getFrameHeaderLength():]
 	def getSize(self):
 		if self._size is None:
-			toBytes = self.toBytes()
-			if toBytes is not None:
-				self._size = len(toBytes)
+			self.toFrame()
 		return self._size
+	def getPriority(self):
+		"""Returns the priority of this message in queues, as configured in messagePriorities. Higher priorities are sent and processed first, and dropped last."""
+		return _getMessagePriority(self.__class__, self._getPriorityType())
+	def _getPriorityType(self):
+		"""Returns the type that messagePriorities may refer to as 'Class:type', or None."""
+		return None
 	def getType(self):
 		return self._content['type']
 	def getTimestamp(self):
 		return self._content['timestamp']
 	def getSender(self):
 		return kozoSystem().getNodeByName(self._content['sender'])
+	def getSenderName(self):
+		return self._content['sender']
+	def _resolveData(self):
+		"""Decodes any part of the message data that was left encoded on reception."""
+		pass
 	def getData(self):
+		self._resolveData()
 		return self._content['data']
+	def tryResolveData(self):
+		"""Decodes any part of the message data that was left encoded on reception. Returns False, after warning, if it cannot be decoded."""
+		try:
+			self._resolveData()
+		except Exception as e:
+			warn('Cannot decode data of', self.__class__.__name__, 'message from', self.getSenderName(), e, printTraceback=False)
+			return False
+		return True
 
 class Heartbeat(_Message):
 	def __init__(self, toNode):
@@ -138,6 +430,61 @@ class Heartbeat(_Message):
 	def getRecipientNodes(self):
 		return [self._toNode]
 
+class Reachability(_Message):
+	"""Sent by relay nodes to the nodes they are connected to, to advertise how many hops away from them each node they can reach is."""
+	def __init__(self, toNode, distances):
+		_Message.__init__(self, 'reachability', {
+			'distances': distances,
+		})
+		self._toNode = toNode
+	def getRecipientNodes(self):
+		return [self._toNode]
+	def getDistances(self):
+		"""Returns a dictionary mapping node names to their distance from the sender, in hops."""
+		return self.getData()['distances']
+
+class Relayed(_Message):
+	"""
+	Carries a message through relay nodes, to nodes that the sender has no connection to.
+	Fan-out messages are instead relayed by each of their destinations, along a tree made of the destination list, so that the sender only sends a few copies.
+	"""
+	def __init__(self, toNode, relayId, destinations, hopLimit, priority, payload, fanOut=False):
+		_Message.__init__(self, 'relayed', {
+			'id': relayId,
+			'destinations': [node.getName() for node in destinations],
+			'hops': hopLimit,
+			'priority': priority,
+			'message': payload,
+			'fanOut': fanOut,
+		})
+		self._toNode = toNode
+	@classmethod
+	def newRelayId(cls):
+		return struct.unpack('Q', os.urandom(8))[0]
+	@classmethod
+	def wrap(cls, toNode, message, destinations, relayId, hopLimit=None, fanOut=False):
+		"""Wraps the given message for the given destinations, to be relayed by toNode. Copies of it sent through other nodes must have the same relay ID."""
+		return cls(toNode, relayId, destinations, kozoConfig('relayHopLimit') if hopLimit is None else hopLimit, message.getPriority(), message.toStorableBytes(), fanOut)
+	def forward(self, toNode, destinations):
+		"""Returns a copy of this message to be relayed further by toNode, to the given destinations, one hop closer to the hop limit."""
+		data = self.getData()
+		return self.__class__(toNode, data['id'], destinations, data['hops'] - 1, data['priority'], data['message'], data.get('fanOut', False))
+	def getRecipientNodes(self):
+		return [self._toNode]
+	def getPriority(self):
+		return self.getData()['priority']
+	def getRelayId(self):
+		return self.getData()['id']
+	def getDestinations(self):
+		return [node for node in (kozoSystem().getNodeByName(name) for name in self.getData()['destinations']) if node is not None]
+	def isFanOut(self):
+		return self.getData().get('fanOut', False)
+	def getHopLimit(self):
+		"""Returns how many more times this message may be relayed."""
+		return self.getData()['hops']
+	def getRelayedMessage(self):
+		return decodeMessage(self.getData()['message'])
+
 class RoleStorage(_Message):
 	@classmethod
 	def load(cls, role):
@@ -176,12 +523,17 @@ class RoleStorage(_Message):
 		})
 	def getRecipientNodes(self):
 		return []
+	def _resolveData(self):
+		_resolveLazy(self._content['data'], 'data')
 	def getRole(self):
-		return self.getSender().getRoleByName(self.getData()['role'])
+		return self.getSender().getRoleByName(self._content['data']['role'])
 	def getRoleStorage(self):
-		return self.getData()['data']
+		return _resolveLazy(self._content['data'], 'data')
 	def save(self):
-		storage = self.toBytes()
+		frame = self.toStorableFrame()
+		if frame is None:
+			raise KozoError('Cannot serialize storage of role', self.getRole().getName())
+		storage = frame[getFrameHeaderLength():]
 		target = self._getTargetFile(self.getRole())
 		parent = os.path.dirname(target)
 		if not os.path.exists(parent):
@@ -206,21 +558,23 @@ class RoleMessage(_Message):
 			'roleData': data
 		})
 	def getRecipientNodes(self):
-		recipients = []
-		for node in _Message.getRecipientNodes(self):
-			for role in node.getRoles():
-				if role.isInterestedIn(self):
-					recipients.append(node)
-					break
-		return recipients
+		return kozoSystem().getSubscriptionIndex().getInterestedNodes(self)
+	def _resolveData(self):
+		roleData = self._roleData()
+		for key in roleData.keys():
+			_resolveLazy(roleData, key)
+	def _roleData(self):
+		return self._content['data']['roleData']
 	def getRoleType(self):
-		return self.getData()['roleMessageType']
+		return self._content['data']['roleMessageType']
 	def getSenderRole(self):
-		return self.getSender().getRoleByName(self.getData()['fromRole'])
+		return self.getSender().getRoleByName(self._content['data']['fromRole'])
+	def getSenderRoleName(self):
+		return self._content['data']['fromRole']
 	def getSenderRoleClass(self):
 		return self.getSenderRole().__class__
 	def getChannel(self):
-		return self.getData()['channel']
+		return self._content['data']['channel']
 	def getRoleData(self):
 		return self.getData()['roleData']
 
@@ -231,9 +585,11 @@ class Event(RoleMessage):
 			'eventData': eventData
 		})
 	def getEventType(self):
-		return self.getRoleData()['eventType']
+		return self._roleData()['eventType']
+	def _getPriorityType(self):
+		return self.getEventType()
 	def getEventData(self):
-		return self.getRoleData()['eventData']
+		return _resolveLazy(self._roleData(), 'eventData')
 
 class Order(RoleMessage):
 	def __init__(self, fromRole, orderType, channel=None, orderData={}):
@@ -242,9 +598,11 @@ class Order(RoleMessage):
 			'orderData': orderData
 		})
 	def getOrderType(self):
-		return self.getRoleData()['orderType']
+		return self._roleData()['orderType']
+	def _getPriorityType(self):
+		return self.getOrderType()
 	def getOrderData(self):
-		return self.getRoleData()['orderData']
+		return _resolveLazy(self._roleData(), 'orderData')
 
 class Log(RoleMessage):
 	def __init__(self, fromRole, *message):
@@ -252,4 +610,4 @@ class Log(RoleMessage):
 			'message': ' '.join(map(str, message))
 		})
 	def getMessage(self):
-		return self.getRoleData()['message']
+		return self._roleData()['message']
@@ -37,7 +37,7 @@ def kozoRole(role, roleName, nodeName):
 	if roleData.roleInfo['format'] != '1.0':
 		raise KozoError(role, 'has unsupported role format', roleData.roleInfo['format'])
 	roleClass = roleData.roleInfo['class']
-	roleDefaultConfig = {'type': role}
+	roleDefaultConfig = {'type': role, 'messageQueueLength': None, 'messageQueueSize': None, 'ownProcess': False} # Options accepted by all roles
 	roleConfigRequired = []
 	for key in roleData.roleInfo['config']:
 		if 'default' in roleData.roleInfo['config'][key]:
@@ -1,11 +1,12 @@
 from kozo import Role
 from kozo.messages import Event
+from kozo.subscriptions import Subscription
 
 class Cuckoo(Role):
 	def localInit(self):
 		self._lastCuckoo = self.getStorage()
-	def isInterestedIn(self, message):
-		return isinstance(message, Event) and message.getEventType() == 'tick' and (self['timer'] == '*' or message.getSenderRole().getName() == self['timer'])
+	def getSubscriptions(self):
+		return [Subscription(Event, type='tick', senderRole=self['timer'])]
 	def run(self):
 		message = self.getMessage()
 		if message is not None:
@@ -1,13 +1,14 @@
 import time
 from kozo import Role
 from kozo.messages import Order
+from kozo.subscriptions import Subscription, ANY
 
 class Debugger(Role):
 	def localInit(self):
 		import rpdb2
 		self._rpdb2 = rpdb2
-	def isInterestedIn(self, message):
-		return isinstance(message, Order) and message.getOrderType() == 'debug' and (self['channel'] is None or message.getChannel() == self['channel'])
+	def getSubscriptions(self):
+		return [Subscription(Order, type='debug', channel=ANY if self['channel'] is None else self['channel'])]
 	def run(self):
 		message = self.getMessage()
 		if message is not None:
@@ -2,6 +2,7 @@ import os
 import time
 from kozo import Role, NODE_NAME
 from kozo.messages import Log, RoleMessage
+from kozo.subscriptions import Subscription
 
 class Logger(Role):
 	def localInit(self):
@@ -12,8 +13,8 @@ class Logger(Role):
 		self._rotateCounter = self['rotateEvery']
 		self._timePrefix = self['timePrefix']
 		self._file.write(time.strftime(self._timePrefix) + 'Log started.\n')
-	def isInterestedIn(self, message):
-		return isinstance(message, Log) and (self['nodeRestrict'] == '*' or message.getSenderRole().getNode().getName() == self['nodeRestrict'])
+	def getSubscriptions(self):
+		return [Subscription(Log, senderNode=self['nodeRestrict'])]
 	def _rotate(self):
 		for i in xrange(self['rotateMax'] - 1, 0, -1):
 			logfile = self['file'] + '.' + str(i)
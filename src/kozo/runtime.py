@@ -1,14 +1,20 @@
+import collections
 import itertools
+import multiprocessing
+import os
+import Queue
 import random
-import struct
+import select
+import signal
 import threading
 import time
-from .kozo import kozoSystem, kozoRuntime, kozoConfig, KozoStopError, Node
+from .kozo import kozoSystem, kozoRuntime, kozoConfig, KozoError, KozoStopError, Role, Node, Transport
 from .messages import *
 from .log import *
-from .helpers import randomWait, RollingQueue
-
-_messageMagicHeader = 'KOZOMSG'
+from .frames import *
+from .helpers import randomWait, RollingQueue, WorkerPool, Timers, PhiAccrualDetector, LinkStats
+from .spool import Spool
+from .subscriptions import SubscriptionIndex
 
 class KozoRuntime(object):
 	def __init__(self):
@@ -17,11 +23,27 @@ class KozoRuntime(object):
 		self._roleThreads = {}
 		self._connectionThreads = {}
 		self._incomingChannelThreads = {}
+		self._failureDetectors = {}
+		self._suspectedNodes = set() # Nodes whose connections are being closed by a connection worker
+		self._receivedSequences = {} # Node -> [stream ID, last sequence number received in order from it]
+		self._sequencesLock = threading.Lock()
+		self._routes = {} # Node -> (number of hops, next hop Node, expiry time), learned from relay nodes' advertisements
+		self._seenRelayIds = collections.OrderedDict() # IDs of the relayed messages we handled recently, oldest first
+		self._routesLock = threading.Lock()
+		self._localSubscriptions = None
+		self._eventLoop = None
+		self._timers = Timers()
+		self._timerThread = None
+		self._connectionWorkers = None
+		self._linkStats = LinkStats()
 	def _allThreads(self, key=lambda x: True):
 		allThreads = self._transportThreads + self._roleThreads.values() + self._connectionThreads.values() + self._incomingChannelThreads.values()
+		for thread in (self._eventLoop, self._timerThread):
+			if thread is not None:
+				allThreads.append(thread)
 		return filter(key, allThreads)
 	def _allActiveThreads(self):
-		return self._allThreads(key=lambda x: not x.daemon)
+		return self._allThreads(key=lambda x: not x.daemon and x.ident is not None) # Threads driven by the event loop are never started
 	def start(self):
 		for node in kozoSystem().getNodes():
 			for transport in node.getTransports():
@@ -29,6 +51,25 @@ class KozoRuntime(object):
 			for role in node.getRoles():
 				role.init()
 		selfNode = kozoSystem().getSelfNode()
+		for role in selfNode.getRoles():
+			if role.runsInOwnProcess():
+				self._roleThreads[role] = RoleProcessThread(role)
+				self._roleThreads[role].startProcess() # Fork before starting any thread or binding any socket
+		if kozoConfig('runtimeMode') == 'eventloop':
+			self._eventLoop = EventLoopThread(kozoConfig('eventLoopWorkers'), self._timers)
+		elif kozoConfig('runtimeMode') == 'threads':
+			self._timerThread = TimerThread(self._timers)
+		else:
+			raise KozoError('Invalid runtimeMode:', kozoConfig('runtimeMode'))
+		self._connectionWorkers = WorkerPool(kozoConfig('connectionWorkers'), name='Connection worker')
+		self._connectionWorkers.start()
+		kozoSystem().getSubscriptionIndex()
+		self._localSubscriptions = SubscriptionIndex(selfNode.getRoles())
+		if kozoConfig('topology') not in ('mesh', 'hubAndSpoke'):
+			raise KozoError('Invalid topology:', kozoConfig('topology'))
+		hubAndSpoke = kozoConfig('topology') == 'hubAndSpoke'
+		if hubAndSpoke and not kozoSystem().getNodesBy(lambda node: node.isRelay()):
+			raise KozoError('The hubAndSpoke topology needs at least one relay node.')
 		tryOutgoingConnections = selfNode.getSelfToOthersConnectPolicy() != Node.CONNECTPOLICY_NEVER
 		listenIncomingConnections = selfNode.getOthersToSelfConnectPolicy() != Node.CONNECTPOLICY_NEVER
 		for transport in selfNode.getTransports():
@@ -41,17 +82,227 @@ class KozoRuntime(object):
 						for remoteTransport in node.getTransports():
 							numAccepts += remoteTransport.canConnect(transport)
 				numAccepts = max(min(numAccepts, len(kozoSystem().getNodes()) // 2), 1)
+				if self._eventLoop is not None:
+					numAccepts = 1 # Transports have no common way to accept without blocking, so keep a single accept() thread per transport.
 				for i in xrange(numAccepts):
 					self._transportThreads.append(TransportThread(transport, i))
 				transport.bind()
 		for role in selfNode.getRoles():
-			role.localInit()
-			self._roleThreads[role] = RoleThread(role)
+			if not role.runsInOwnProcess():
+				role.localInit()
+				self._roleThreads[role] = RoleThread(role)
 		for node in kozoSystem().getNodes():
+			if hubAndSpoke and not selfNode.isRelay() and not node.isRelay():
+				continue # Leaves only connect to relays
 			if not node.isSelf() and tryOutgoingConnections and node.getOthersToSelfConnectPolicy() != Node.CONNECTPOLICY_NEVER:
 				self._connectionThreads[node] = ConnectionThread(node)
-		for thread in self._allThreads():
-			thread.start()
+		for connectionThread in self._connectionThreads.values():
+			self._timers.callEvery(kozoConfig('heartbeat'), lambda connectionThread=connectionThread: self._heartbeat(connectionThread), 'heartbeat')
+		if selfNode.isRelay():
+			self._timers.callEvery(kozoConfig('relayAdvertiseInterval'), self._advertiseReachability, 'reachability')
+		if kozoConfig('idleTimeout'):
+			self._timers.callEvery(kozoConfig('idleTimeout') / 4.0, self._closeIdleConnections, 'idle connections')
+		if kozoConfig('failureDetectorThreshold'):
+			self._timers.callEvery(kozoConfig('heartbeat') / 4.0, self._checkFailureDetectors, 'failure detector')
+		if self._eventLoop is None:
+			for thread in self._allThreads():
+				thread.start()
+		else:
+			for thread in self._transportThreads:
+				thread.start()
+			for roleThread in self._roleThreads.values():
+				if isinstance(roleThread, RoleProcessThread):
+					roleThread.start() # Waits on its process rather than running the role
+				else:
+					self._eventLoop.addRole(roleThread)
+			for connectionThread in self._connectionThreads.values():
+				self._eventLoop.addConnection(connectionThread)
+			self._eventLoop.start()
+	def getTimers(self):
+		return self._timers
+	def getConnectionWorkers(self):
+		"""Returns the WorkerPool running connection attempts beyond the first one of each connection, and opening and checking standby channels."""
+		return self._connectionWorkers
+	def getLinkStats(self):
+		"""Returns the LinkStats used to pick which transports and addresses to connect over."""
+		return self._linkStats
+	def getTimerStats(self):
+		"""Returns a dictionary mapping the names of pending timers (heartbeat, reconnect, linger...) to a (number pending, seconds until the next one is due) tuple."""
+		return self._timers.getStats()
+	def _heartbeat(self, connectionThread):
+		if connectionThread.shouldSendHeartbeat():
+			self.sendMessage(Heartbeat(connectionThread.getNode()))
+		connectionThread.maintainStandby()
+	def _advertiseReachability(self):
+		"""Tells the nodes we are connected to which nodes we can relay messages to, and how many hops away they are."""
+		now = time.time()
+		connected = [node for node, connectionThread in self._connectionThreads.iteritems() if connectionThread.isConnected()]
+		with self._routesLock:
+			routes = [(node, route) for node, route in self._routes.iteritems() if route[2] >= now]
+		for neighbor in connected:
+			distances = dict((node.getName(), 1) for node in connected if node is not neighbor)
+			for node, (hops, nextHop, _) in routes:
+				if nextHop is not neighbor and node is not neighbor and hops < distances.get(node.getName(), hops + 1): # Don't advertise routes back to where they came from
+					distances[node.getName()] = hops
+			self._connectionThreads[neighbor].sendMessage(Reachability(neighbor, distances))
+	def _updateRoutes(self, reachability):
+		neighbor = reachability.getSender()
+		if neighbor is None or neighbor not in self._connectionThreads:
+			return
+		now = time.time()
+		expiry = now + 3 * kozoConfig('relayAdvertiseInterval')
+		with self._routesLock:
+			for name, hops in reachability.getDistances().iteritems():
+				node = kozoSystem().getNodeByName(name)
+				if node is None or node.isSelf() or hops + 1 > kozoConfig('relayHopLimit'):
+					continue
+				route = self._routes.get(node)
+				if route is None or route[2] < now or route[1] is neighbor or hops + 1 <= route[0]:
+					self._routes[node] = (hops + 1, neighbor, expiry)
+	def _getNextHops(self, destinations, exclude=()):
+		"""
+		Returns a dictionary mapping the nodes to relay a message through to the destinations each should get it to.
+		Destinations we have no route to are sent to all the relay nodes we are connected to.
+		"""
+		now = time.time()
+		nextHops = {}
+		relays = None
+		for destination in destinations:
+			if destination in self._connectionThreads:
+				nextHops.setdefault(destination, []).append(destination)
+				continue
+			with self._routesLock:
+				route = self._routes.get(destination)
+			if route is not None and route[2] >= now and route[1] in self._connectionThreads:
+				nextHops.setdefault(route[1], []).append(destination)
+				continue
+			if relays is None:
+				relays = [node for node, connectionThread in self._connectionThreads.iteritems() if node.isRelay() and node not in exclude and connectionThread.isConnected()]
+			for relay in relays:
+				nextHops.setdefault(relay, []).append(destination)
+		return nextHops
+	def _markRelayIdSeen(self, relayId):
+		"""Returns whether the relayed message with the given ID was seen before, and remembers it otherwise."""
+		with self._routesLock:
+			if relayId in self._seenRelayIds:
+				return True
+			self._seenRelayIds[relayId] = True
+			if len(self._seenRelayIds) > 4096:
+				self._seenRelayIds.popitem(last=False)
+			return False
+	def _relayMessage(self, message, destinations, timeout):
+		"""Sends the given message through relay nodes to the given destinations. Returns the number of messages dropped to make room for it."""
+		dropped = 0
+		relayId = Relayed.newRelayId()
+		self._markRelayIdSeen(relayId)
+		nextHops = self._getNextHops(destinations)
+		for node in destinations:
+			if not any(node in reached for reached in nextHops.itervalues()):
+				warn('Tried to send a message to', node, 'but no connection thread for it exists and no relay node is connected; likely a connection policy issue.')
+		for nextHop, reached in nextHops.iteritems():
+			dropped += self._connectionThreads[nextHop].sendMessage(Relayed.wrap(nextHop, message, reached, relayId), timeout)
+		return dropped
+	def _handOffRelayed(self, relayed):
+		"""Delivers a relayed message if we are one of its destinations, and relays it further if we are a relay node."""
+		if self._markRelayIdSeen(relayed.getRelayId()):
+			return 0
+		dropped = 0
+		selfNode = kozoSystem().getSelfNode()
+		destinations = relayed.getDestinations()
+		if selfNode in destinations:
+			message = relayed.getRelayedMessage()
+			if message is not None:
+				dropped += self.handOffIncomingMessage(message)
+			destinations.remove(selfNode)
+		if not destinations or relayed.getHopLimit() <= 0:
+			return dropped
+		if relayed.isFanOut():
+			for nextHop, subtree in self._getFanOutHops(destinations).iteritems():
+				self._connectionThreads[nextHop].sendMessage(relayed.forward(nextHop, subtree))
+		elif selfNode.isRelay():
+			for nextHop, reached in self._getNextHops(destinations, (relayed.getSender(),)).iteritems():
+				self._connectionThreads[nextHop].sendMessage(relayed.forward(nextHop, reached))
+		return dropped
+	def _getFanOutHops(self, destinations):
+		"""
+		Splits the given destinations into up to broadcastFanOut subtrees of consecutive destinations, each to be sent to the first node in it, which sends it further the same way.
+		Returns a dictionary mapping the nodes to send a message to, to the destinations in the subtree each gets.
+		Nodes we have no connection to are reached through relay nodes. If none is connected, the next node in the subtree takes its place.
+		"""
+		nextHops = {}
+		fanOut = max(1, kozoConfig('broadcastFanOut'))
+		size, extra = divmod(len(destinations), fanOut)
+		start = 0
+		for i in xrange(min(fanOut, len(destinations))):
+			end = start + size + (i < extra)
+			subtree = destinations[start:end]
+			start = end
+			while subtree:
+				hops = (subtree[0],) if subtree[0] in self._connectionThreads else self._getNextHops(subtree[:1]).keys()
+				if hops:
+					break
+				warn('Tried to send a message to', subtree[0], 'but no connection thread for it exists and no relay node is connected; likely a connection policy issue.')
+				subtree = subtree[1:]
+			for nextHop in (hops if subtree else ()):
+				nextHops.setdefault(nextHop, []).extend(subtree)
+		return nextHops
+	def _getFanOutDepth(self, count):
+		"""Returns the depth of the tree that _getFanOutHops() makes of the given number of destinations, which is 1 more than the number of times it gets forwarded."""
+		fanOut = max(1, kozoConfig('broadcastFanOut'))
+		depth = 0
+		while count > 0:
+			count = (count + fanOut - 1) // fanOut - 1 # The largest subtree, without the node it is sent to
+			depth += 1
+		return depth
+	def _fanOutMessage(self, message, destinations, timeout):
+		"""
+		Sends the given message to a few of the given destinations, which send it further along a tree made of the others.
+		The destinations are ordered starting after this node's name, so that nodes sending broadcasts don't all use the same tree. Returns the number of messages dropped to make room for it.
+		"""
+		selfName = kozoSystem().getSelfNode().getName()
+		destinations = sorted(destinations, key=lambda node: (node.getName() < selfName, node.getName()))
+		relayId = Relayed.newRelayId()
+		self._markRelayIdSeen(relayId)
+		hopLimit = kozoConfig('relayHopLimit') + self._getFanOutDepth(len(destinations))
+		dropped = 0
+		for nextHop, subtree in self._getFanOutHops(destinations).iteritems():
+			dropped += self._connectionThreads[nextHop].sendMessage(Relayed.wrap(nextHop, message, subtree, relayId, hopLimit, True), timeout)
+		return dropped
+	def _closeIdleConnections(self):
+		for connectionThread in self._connectionThreads.values():
+			connectionThread.closeIfIdle(kozoConfig('idleTimeout'))
+	def _getFailureDetector(self, node):
+		with self._lock:
+			if node not in self._failureDetectors:
+				# Heartbeats are only sent after a full period without traffic, so channels may stay quiet for one heartbeat period longer than usual.
+				# With the default threshold, a node that stopped sending anything is suspected less than 2.5 heartbeat periods after its usual interval.
+				self._failureDetectors[node] = PhiAccrualDetector(minStdDev=kozoConfig('heartbeat') / 4.0, acceptablePause=kozoConfig('heartbeat'), expectedInterval=kozoConfig('heartbeat'))
+			return self._failureDetectors[node]
+	def getSuspicion(self, node):
+		"""Returns how likely it is that the given node is dead, as a phi accrual suspicion level (0 meaning it is fine), or None if it is not connected to us."""
+		receptionThread = self._incomingChannelThreads.get(node)
+		if receptionThread is None or not receptionThread.getChannel().isAlive():
+			return None
+		return self._getFailureDetector(node).phi()
+	def _checkFailureDetectors(self):
+		"""Runs as a timer, so connections to suspected nodes are closed by a connection worker, as failing over or spooling their queue may block."""
+		for node, receptionThread in self._incomingChannelThreads.items():
+			suspicion = self.getSuspicion(node)
+			if suspicion is not None and suspicion > kozoConfig('failureDetectorThreshold'):
+				with self._lock:
+					if node in self._suspectedNodes:
+						continue
+					self._suspectedNodes.add(node)
+				warnRuntime(receptionThread, 'Node', node, 'is suspected to be dead (phi = %.1f); closing connections to it.' % suspicion)
+				self._connectionWorkers.submit(self._closeSuspected, node, receptionThread)
+	def _closeSuspected(self, node, receptionThread):
+		try:
+			receptionThread.kill()
+			if node in self._connectionThreads and self._connectionThreads[node].isConnected():
+				self._connectionThreads[node].kill()
+		finally:
+			with self._lock:
+				self._suspectedNodes.discard(node)
 	def isAlive(self):
 		for thread in self._allActiveThreads():
 			if thread.isAlive():
@@ -59,6 +310,8 @@ class KozoRuntime(object):
 	def kill(self):
 		for role in kozoSystem().getSelfNode().getRoles():
 			role.kill()
+		if self._eventLoop is not None:
+			self._eventLoop.kill()
 	def join(self, verbose=False):
 		while self.isAlive():
 			for thread in self._allActiveThreads():
@@ -72,27 +325,119 @@ class KozoRuntime(object):
 					if verbose:
 						info('Got exception while waiting for runtime thread', thread, e)
 					raise
-	def handOffIncomingChannel(self, channel):
+	def _startReception(self, receptionThread):
+		if self._eventLoop is not None and receptionThread.getChannel().fileno() is not None:
+			self._eventLoop.addReception(receptionThread)
+		else:
+			receptionThread.start()
+	def _handOffReception(self, node, receptionThread):
+		"""Makes the given thread the one receiving from the given node, and kills the previous one."""
 		with self._lock:
-			if channel.getFromNode() in self._incomingChannelThreads:
-				self._incomingChannelThreads[channel.getFromNode()].kill()
-			self._incomingChannelThreads[channel.getFromNode()] = ReceptionThread(channel)
-			self._incomingChannelThreads[channel.getFromNode()].start()
+			previous = self._incomingChannelThreads.get(node)
+			self._incomingChannelThreads[node] = receptionThread
+		if previous is not None and previous is not receptionThread:
+			previous.kill()
+	def handOffIncomingChannel(self, channel):
+		"""
+		Starts receiving over the given channel. It only replaces the previous channel from the same node once the node starts using it,
+		as the node may have opened several channels at once and closed all but one of them, or may keep it as a standby channel.
+		"""
+		self._startReception(ReceptionThread(channel, self._getFailureDetector(channel.getFromNode())))
+	def handOffActiveReception(self, receptionThread, capabilities=None):
+		"""
+		Called when the node starts using an incoming channel: when its first frame arrives, or for standby channels, when the first message does.
+		If that first frame is a hello frame, capabilities are the ones the node advertised, which it does when it can also receive over that channel.
+		Returns whether the channel is used; if not, it is killed.
+		"""
+		channel = receptionThread.getChannel()
+		node = channel.getFromNode()
+		connectionThread = self._connectionThreads.get(node)
+		if kozoConfig('bidirectionalChannels') and capabilities is not None and b'duplex' in capabilities and connectionThread is not None:
+			if not connectionThread.attachChannel(channel, FrameWriter(channel, capabilities), True):
+				return False
+		self._handOffReception(node, receptionThread)
+		return True
+	def handOffDuplexChannel(self, channel, reader):
+		"""Starts receiving over a bidirectional channel we opened, with the reader used to negotiate it."""
+		node = channel.getToNode()
+		receptionThread = ReceptionThread(channel, self._getFailureDetector(node), reader)
+		self._handOffReception(node, receptionThread)
+		self._startReception(receptionThread)
+	def handOffDeadChannel(self, channel):
+		"""Called when a channel we received from is lost. If it was bidirectional, we can no longer send over it either."""
+		node = channel.getToNode() if channel.getFromNode().isSelf() else channel.getFromNode()
+		connectionThread = self._connectionThreads.get(node)
+		if connectionThread is not None:
+			connectionThread.detachChannel(channel)
 	def handOffIncomingMessage(self, message):
+		"""Delivers the given message to the local roles interested in it. Returns the number of messages dropped from their queues to make room for it."""
+		dropped = 0
 		if isinstance(message, Heartbeat):
 			pass # Nothing to do, reception thread automatically knows
+		elif isinstance(message, Reachability):
+			self._updateRoutes(message)
+		elif isinstance(message, Relayed):
+			dropped += self._handOffRelayed(message)
 		elif isinstance(message, RoleMessage):
-			for role in kozoSystem().getSelfNode().getRoles():
-				if role.isInterestedIn(message):
-					self._roleThreads[role].deliver(message)
-	def sendMessage(self, message):
+			for role in self._localSubscriptions.getInterestedRoles(message):
+				dropped += self._roleThreads[role].deliver(message)
+		return dropped
+	def handOffSequencedMessage(self, node, stream, sequence, payload):
+		"""Delivers the message with the given sequence number in the given node's stream, unless it was received already."""
+		with self._sequencesLock:
+			received = self._receivedSequences.get(node)
+			if received is None or received[0] != stream:
+				received = self._receivedSequences[node] = [stream, sequence - 1] # The node restarted, or we did
+			if sequence <= received[1]:
+				return
+			missed = sequence - received[1] - 1
+			received[1] = sequence
+		if missed:
+			info('Missed', missed, 'messages from', node, '; they were dropped from its retransmit window.')
+		self.handOffIncomingMessage(decodeMessage(payload))
+	def acknowledgeReceived(self, node):
+		"""Acknowledges the messages received in order from the given node, over our next frames to it."""
+		with self._sequencesLock:
+			received = self._receivedSequences.get(node)
+		connectionThread = self._connectionThreads.get(node)
+		if received is not None and connectionThread is not None:
+			connectionThread.queueAck(received[0], received[1])
+	def handOffAck(self, node, stream, sequence):
+		connectionThread = self._connectionThreads.get(node)
+		if connectionThread is not None:
+			connectionThread.acknowledge(stream, sequence)
+	def sendMessage(self, message, timeout=0, congested=None):
+		"""
+		Queues the given message for all its recipients. Returns the number of messages dropped from their queues to make room for it.
+		If the outgoing queue to a recipient is full, waits up to timeout seconds (forever if None) overall for it to have room.
+		If congested is a list, the connected recipients whose outgoing queue is filled above outgoingQueueHighWatermark are appended to it.
+		"""
+		deadline = None if timeout is None else time.time() + timeout
+		dropped = 0
+		connected = []
+		unconnected = []
 		for node in message.getRecipientNodes():
 			if node.isSelf():
-				self.handOffIncomingMessage(message)
+				dropped += self.handOffIncomingMessage(message)
 			elif node in self._connectionThreads:
-				self._connectionThreads[node].sendMessage(message)
+				connected.append(node)
 			else:
-				warn('Tried to send a message to', node, 'but no connection thread for it exists; likely a connection policy issue.')
+				unconnected.append(node)
+		if kozoConfig('broadcastFanOut') and isinstance(message, RoleMessage) and len(connected) > kozoConfig('broadcastFanOut'):
+			dropped += self._fanOutMessage(message, connected, None if deadline is None else max(0, deadline - time.time()))
+		else:
+			for node in connected:
+				dropped += self._connectionThreads[node].sendMessage(message, None if deadline is None else max(0, deadline - time.time()))
+		if unconnected:
+			dropped += self._relayMessage(message, unconnected, None if deadline is None else max(0, deadline - time.time()))
+		if congested is not None:
+			congested.extend(node for node in connected if self._connectionThreads[node].isCongested())
+		return dropped
+	def getDroppedCounts(self):
+		"""Returns a dictionary of how many messages were dropped from each queue, keyed by Node for outgoing queues and by Role for role queues."""
+		counts = dict((node, connectionThread.getDroppedCount()) for node, connectionThread in self._connectionThreads.iteritems())
+		counts.update((role, roleThread.getDroppedCount()) for role, roleThread in self._roleThreads.iteritems())
+		return counts
 
 class KozoThread(threading.Thread):
 	_threadNumber = itertools.count() # Atomic
@@ -142,59 +487,141 @@ class TransportThread(KozoThread):
 				warnRuntime(self, 'Could not accept channel', e)
 
 class ReceptionThread(KozoThread):
-	def __init__(self, channel):
+	def __init__(self, channel, failureDetector, reader=None):
 		self._channel = channel
+		self._remoteNode = channel.getToNode() if channel.getFromNode().isSelf() else channel.getFromNode()
+		self._reader = reader
+		self._handedOff = reader is not None # Bidirectional channels we opened are handed off right away
+		self._standby = False # Standby channels are handed off once messages are sent over them
+		self._sequence = None # (stream ID, sequence number) of the next message frame, if the last frame numbered it
+		self._failureDetector = failureDetector # Only fed once this is the node's active reception, so that standby channels don't hide a dead one
+		if self._handedOff:
+			self._failureDetector.restart()
 		KozoThread.__init__(self, name='Reception for ' + str(self._channel))
 		self.daemon = True
+	def getChannel(self):
+		return self._channel
 	def kill(self):
 		KozoThread.kill(self)
 		self._channel.kill()
 		infoRuntime(self, 'Killed')
-	def _receiveBytes(self, bytes, timeout):
-		totalData = b''
-		bufferSize = max(1, min(kozoConfig('maxBufferReadSize'), bytes))
-		deadline = time.time() + timeout * (1 + bytes / bufferSize)
-		while len(totalData) < bytes:
-			data = self._channel.wrapReceive(min(bytes - len(totalData), bufferSize), timeout)
-			if not data or time.time() > deadline:
-				return b''
-			totalData += data
-		return totalData
+		kozoRuntime().handOffDeadChannel(self._channel)
+	def greet(self):
+		"""Advertises our capabilities to the remote end, and gets ready to receive. Bidirectional channels we opened already have a reader, and were greeted while connecting."""
+		if self._reader is not None:
+			return
+		try:
+			self._channel.wrapSendAll(encodeHelloFrame())
+		except BaseException as e:
+			infoRuntime(self, 'Could not send hello frame; the remote end will not compress.', e, printTraceback=False)
+		self._reader = FrameReader(self._channel, kozoConfig('maxBufferReadSize'))
+	def receiveStep(self, timeout):
+		"""Reads from the channel once and hands off the messages this completed. Returns False and kills the channel if this failed or timed out."""
+		try:
+			frames = self._reader.read(timeout)
+			if frames is None:
+				infoRuntime(self, 'Channel timeout while trying to read message.')
+				self.kill()
+				return False
+			sequenced = False
+			for frameType, payload in frames:
+				if not self._handedOff:
+					self._handedOff = True
+					capabilities = decodeHelloFrame(payload) if frameType == FRAME_HELLO else None
+					if capabilities is not None and b'standbychannel' in capabilities:
+						self._standby = True
+					elif kozoRuntime().handOffActiveReception(self, capabilities):
+						self._failureDetector.restart()
+					else:
+						return False
+				if frameType in (FRAME_MESSAGE, FRAME_SEQUENCED) and self._standby:
+					self._standby = False
+					self._failureDetector.restart()
+					kozoRuntime().handOffActiveReception(self)
+				if frameType == FRAME_MESSAGE and self._sequence is not None:
+					kozoRuntime().handOffSequencedMessage(self._remoteNode, self._sequence[0], self._sequence[1], payload)
+					self._sequence = None
+					sequenced = True
+				elif frameType == FRAME_MESSAGE:
+					kozoRuntime().handOffIncomingMessage(decodeMessage(payload))
+				elif frameType == FRAME_SEQUENCED:
+					self._sequence = decodeSequencedFrame(payload)
+				elif frameType == FRAME_ACK:
+					kozoRuntime().handOffAck(self._remoteNode, *decodeAckFrame(payload))
+			if not self._standby:
+				self._failureDetector.arrived()
+			if sequenced:
+				kozoRuntime().acknowledgeReceived(self._remoteNode)
+			return True
+		except BaseException as e:
+			warnRuntime(self, 'Failed to receive message', e)
+			self.kill()
+			return False
 	def execute(self):
+		self.greet()
 		while self._channel.isAlive():
-			try:
-				lengthBytes = self._receiveBytes(len(_messageMagicHeader) + struct.calcsize('I'), kozoConfig('connectionRetry'))
-				if lengthBytes:
-					if lengthBytes[:len(_messageMagicHeader)] != _messageMagicHeader:
-						warnRuntime(self, 'Message did not have valid header:', repr(lengthBytes[:len(_messageMagicHeader)]), '; killing connection.')
-						self.kill()
-					else:
-						length = struct.unpack('I', lengthBytes[len(_messageMagicHeader):])[0]
-						messageBytes = self._receiveBytes(length, kozoConfig('connectionRetry'))
-						if messageBytes:
-							message = decodeMessage(messageBytes)
-							kozoRuntime().handOffIncomingMessage(message)
-						else:
-							infoRuntime(self, 'Channel timeout while trying to read message of expected size', length)
-							self.kill()
-				else:
-					infoRuntime(self, 'Channel timeout while trying to read message.')
-					self.kill()
-			except BaseException as e:
-				warnRuntime(self, 'Failed to receive message', e)
-				self.kill()
+			self.receiveStep(kozoConfig('connectionRetry'))
+
+class _RoleRunner(object):
+	"""Runs a role until it is killed. Used by RoleThread, and by RoleProcessClient in the role's own process."""
+	def runStep(self):
+		"""
+		Runs the role once. Returns how long to wait before running it again, or None if it has no rate control.
+		Raises KozoStopError if the role was killed.
+		"""
+		beforeTimestamp = time.time()
+		self._role.run()
+		rateControl = self._role.getRateControl()
+		if type(rateControl) is int or type(rateControl) is float:
+			if self._role.getMessageRateControlOverride() and self.hasMessages():
+				# We have a message, don't sleep
+				return 0
+			return max(0, rateControl - (time.time() - beforeTimestamp))
+		return None
+	def execute(self):
+		rateControl = self._role.getRateControl()
+		try:
+			if rateControl is not None:
+				randomWait(rateControl, sleepFunction=self.sleep)
+			while not self._dead.is_set():
+				delay = self.runStep()
+				if delay:
+					self.sleep(delay)
+		except KozoStopError:
+			pass
 
-class RoleThread(KozoThread):
+class RoleThread(_RoleRunner, KozoThread):
 	def __init__(self, role):
 		self._role = role
-		self._incomingMessagesQueue = RollingQueue(self._role.getMessageQueueLength(), self._role.getMessageQueueSize())
+		self._incomingMessagesQueue = RollingQueue(self._role.getMessageQueueLength(), self._role.getMessageQueueSize(), kozoConfig('queueScheduling'))
+		self._incomingMessagesBatch = collections.deque() # Messages popped from the queue but not handed to the role yet
 		KozoThread.__init__(self, name='Role for ' + str(self._role))
 		self._dead = threading.Event()
+		self._eventLoop = None
 		self._role.setControllingThread(self)
+	def getRole(self):
+		return self._role
+	def setEventLoop(self, eventLoop):
+		self._eventLoop = eventLoop
+	def isDead(self):
+		return self._dead.is_set()
+	def hasMessages(self):
+		return bool(self._incomingMessagesBatch) or not self._incomingMessagesQueue.isEmpty()
+	def getDroppedCount(self):
+		return self._incomingMessagesQueue.getDroppedCount()
 	def deliver(self, message):
-		self._incomingMessagesQueue.push(message, message.getSize())
-	def sendMessage(self, message):
-		kozoRuntime().sendMessage(message)
+		dropped = self._incomingMessagesQueue.push(message, message.getSize(), message.getPriority())
+		if self._eventLoop is not None:
+			self._eventLoop.notifyRole(self)
+		return dropped
+	def sendMessage(self, message, timeout=0):
+		if self._eventLoop is not None:
+			timeout = 0 # Waiting for room would hold a worker, which the connections that make room may need.
+		congestedNodes = []
+		dropped = kozoRuntime().sendMessage(message, timeout, congestedNodes)
+		if congestedNodes:
+			self._role.onBackpressure(congestedNodes)
+		return Role.SEND_DROPPED if dropped else Role.SEND_QUEUED
 	def sleep(self, seconds):
 		isDead = self._dead.wait(seconds)
 		if isDead:
@@ -212,54 +639,274 @@ class RoleThread(KozoThread):
 		Returns:
 			A RoleMessage object, or None if we didn't receive anything in time.
 		"""
-		if timeout is None:
+		if self._eventLoop is not None:
+			timeout = 0 # Workers are shared; the event loop runs the role again once a message arrives.
+		elif timeout is None:
 			timeout = kozoConfig('connectionRetry')
 		else:
 			timeout = min(timeout, kozoConfig('connectionRetry'))
-		return self._incomingMessagesQueue.pop(timeout > 0, timeout)
+		while True:
+			if not self._incomingMessagesBatch:
+				self._incomingMessagesBatch.extend(self._incomingMessagesQueue.popMany(kozoConfig('roleBatchMessages'), None, timeout))
+				if not self._incomingMessagesBatch:
+					return None
+			message = self._incomingMessagesBatch.popleft()
+			if message.tryResolveData(): # Data is decoded lazily; drop messages whose data turns out to be undecodable, rather than failing inside the role.
+				return message
+
+class RoleProcessThread(RoleThread):
+	"""
+	Runs a role in a child process of its own, for roles with the ownProcess option.
+	The role's messages stay queued here; this thread answers the requests the child process sends over a pipe to get them, send messages, and load or save the role's storage.
+	"""
+	_pollInterval = 0.5 # How often to check whether we were killed while the child process is busy
+	def __init__(self, role):
+		RoleThread.__init__(self, role)
+		self._connection = None
+		self._process = None
+		self._processStopped = multiprocessing.Event() # Set when either side stops the role
+	def startProcess(self):
+		self._connection, childConnection = multiprocessing.Pipe()
+		self._process = multiprocessing.Process(target=RoleProcessClient.run, args=(self._role, childConnection, self._processStopped), name=self.name)
+		self._process.daemon = True
+		self._process.start()
+		childConnection.close()
+	def _handleRequest(self, request, *args):
+		if request == 'getMessage':
+			timeout, = args
+			deadline = None if timeout is None else time.time() + timeout
+			while True:
+				message = self.getMessage(timeout)
+				if message is None:
+					return None
+				messageBytes = message.toBytes()
+				if messageBytes is not None:
+					return messageBytes
+				warnRole(self._role, 'Could not serialize message for the role process; dropping it.')
+				if deadline is not None:
+					timeout = max(0, deadline - time.time())
+		if request == 'sendMessage':
+			messageBytes, timeout = args
+			message = decodeMessage(messageBytes)
+			congestedNodes = []
+			dropped = kozoRuntime().sendMessage(message, timeout, congestedNodes)
+			return (Role.SEND_DROPPED if dropped else Role.SEND_QUEUED), [node.getName() for node in congestedNodes]
+		if request == 'hasMessages':
+			return self.hasMessages()
+		if request == 'getStorage':
+			return self._role.getStorage()
+		if request == 'setStorage':
+			return self._role.setStorage(*args)
+		raise KozoError('Unknown request from role process:', request)
+	def kill(self):
+		RoleThread.kill(self)
+		self._processStopped.set()
 	def execute(self):
-		beforeTimestamp = None
-		rateControl = self._role.getRateControl()
 		try:
-			if rateControl is not None:
-				randomWait(rateControl, sleepFunction=self.sleep)
-			while not self._dead.is_set():
-				beforeTimestamp = time.time()
-				self._role.run()
-				rateControl = self._role.getRateControl()
-				if type(rateControl) is int or type(rateControl) is float:
-					if self._role.getMessageRateControlOverride() and not self._incomingMessagesQueue.isEmpty():
-						# We have a message, don't sleep
-						continue
-					afterTimestamp = time.time()
-					if afterTimestamp - beforeTimestamp < rateControl:
-						self.sleep(rateControl - (afterTimestamp - beforeTimestamp))
-		except KozoStopError:
-			pass
+			while not self._dead.is_set() and not self._processStopped.is_set():
+				if self._connection.poll(self._pollInterval):
+					request = self._connection.recv()
+					try:
+						reply = (None, self._handleRequest(*request))
+					except Exception as e:
+						warnRuntime(self, 'Request', request[0], 'from role process failed', e)
+						reply = (str(e), None)
+					self._connection.send(reply)
+		except (EOFError, IOError):
+			if not self._processStopped.is_set():
+				warnRuntime(self, 'Role process exited unexpectedly.')
+		finally:
+			self._processStopped.set()
+			self._process.join(kozoConfig('connectionRetry'))
+			if self._process.is_alive():
+				self._process.terminate()
+			self._connection.close()
 
-class HeartbeatThread(KozoThread):
-	def __init__(self, connectionThread, toNode):
-		self._connectionThread = connectionThread
-		self._toNode = toNode
-		KozoThread.__init__(self, name='Heartbeat to ' + str(self._toNode))
+class RoleProcessClient(_RoleRunner):
+	"""Controls a role in its own process, forwarding what the role asks for to the RoleProcessThread in the node's process."""
+	def __init__(self, role, connection, stopped):
+		self._role = role
+		self._connection = connection
+		self._dead = stopped
+		self._role.setControllingThread(self)
+	@classmethod
+	def run(cls, role, connection, stopped):
+		"""Entry point of the role's process."""
+		signal.signal(signal.SIGINT, signal.SIG_IGN) # The node's process stops us
+		for transport in kozoSystem().getSelfNode().getTransports():
+			transport.unbind() # Leave the listening sockets to the node's process
+		restartLogThread()
+		client = cls(role, connection, stopped)
+		try:
+			role.localInit()
+			client.execute()
+		except (EOFError, IOError):
+			pass # The node's process is gone
+		except BaseException as e:
+			errorRole(role, 'Role process failed:', e)
+		finally:
+			stopped.set()
+			connection.close()
+	def _request(self, *request):
+		self._connection.send(request)
+		error, result = self._connection.recv()
+		if error is not None:
+			raise KozoError('Request', request[0], 'failed in the node process:', error)
+		return result
+	def hasMessages(self):
+		return self._request('hasMessages')
+	def getMessage(self, timeout=None):
+		messageBytes = self._request('getMessage', timeout)
+		if messageBytes is None:
+			return None
+		return decodeMessage(messageBytes)
+	def sendMessage(self, message, timeout=0):
+		messageBytes = message.toBytes()
+		if messageBytes is None:
+			warnRole(self._role, 'Could not serialize message; dropping it.')
+			return Role.SEND_DROPPED
+		status, congestedNodes = self._request('sendMessage', messageBytes, timeout)
+		if congestedNodes:
+			self._role.onBackpressure([kozoSystem().getNodeByName(name) for name in congestedNodes])
+		return status
+	def getStorage(self):
+		return self._request('getStorage')
+	def setStorage(self, storage):
+		return self._request('setStorage', storage)
+	def sleep(self, seconds):
+		if self._dead.wait(seconds):
+			raise KozoStopError()
+	def kill(self):
+		self._dead.set()
+
+class TimerThread(KozoThread):
+	def __init__(self, timers):
+		self._timers = timers
+		self._wakeup = threading.Event()
+		KozoThread.__init__(self, name='Timers')
 		self.daemon = True
+		self._timers.setEarlierCallback(self._wakeup.set)
 	def execute(self):
-		randomWait(kozoConfig('heartbeat'))
 		while True:
-			time.sleep(kozoConfig('heartbeat'))
-			if self._connectionThread.shouldSendHeartbeat():
-				kozoRuntime().sendMessage(Heartbeat(self._toNode))
+			nextTime = self._timers.getNextTime()
+			self._wakeup.wait(None if nextTime is None else max(0, nextTime - time.time()))
+			self._wakeup.clear()
+			self._timers.runDue()
+
+class _ConnectionRace(object):
+	"""Collects the results of concurrent attempts to connect to a node. Once it is finished, channels opened by the attempts that lost are closed."""
+	def __init__(self):
+		self._results = Queue.Queue()
+		self._lock = threading.Lock()
+		self._finished = False
+	def put(self, result):
+		with self._lock:
+			if not self._finished:
+				self._results.put(result)
+				return
+		if result is not None:
+			result[0].kill()
+	def get(self, timeout=None):
+		"""Returns the next result, waiting up to timeout seconds (forever if None) for it. Raises Queue.Empty if none arrived in time."""
+		return self._results.get(True, timeout)
+	def finish(self):
+		with self._lock:
+			self._finished = True
+		while True:
+			try:
+				result = self._results.get(False)
+			except Queue.Empty:
+				return
+			if result is not None:
+				result[0].kill()
 
 class ConnectionThread(KozoThread):
 	def __init__(self, node):
 		self._node = node
 		self._channel = None
-		self._outgoingMessagesQueue = RollingQueue(kozoConfig('outgoingQueueLength'), kozoConfig('outgoingQueueSize'))
-		self._heartbeatThread = HeartbeatThread(self, self._node)
+		self._writer = None
+		self._channelLock = threading.Lock()
+		self._sendLock = threading.RLock() # Held while writing to the channel; the writer is only replaced while holding it, so that nothing is written to a channel once it was dropped
+		self._duplex = False # Whether the channel is bidirectional
+		self._attachedAt = 0
+		self._transports = None # (Origin transport, target transport) of the channel, if we opened it
+		self._standby = None # (channel, writer, transports)
+		self._openingStandby = False
+		self._nextStandbyAttempt = 0
+		self._standbyIdle = threading.Event() # Cleared while a heartbeat is being written to the standby channel
+		self._standbyIdle.set()
+		self._outgoingMessagesQueue = RollingQueue(kozoConfig('outgoingQueueLength'), kozoConfig('outgoingQueueSize'), kozoConfig('queueScheduling'))
+		self._spool = None
+		self._spoolLock = threading.Lock() # Held while moving messages between the queue and the spool, so that they stay in order
+		if node.getSpool():
+			if kozoConfig('spoolPath') is None:
+				raise KozoError('Node', node.getName(), 'asks for a spool, but spoolPath is not set.')
+			self._spool = Spool(os.path.join(kozoConfig('spoolPath'), kozoSystem().getSelfNode().getName(), node.getName()), kozoConfig('spoolMaxSize'), kozoConfig('spoolMaxAge'), kozoConfig('spoolSegmentSize'))
+		self._stream = random.getrandbits(64) # Sequence numbers start over in a new stream whenever we restart
+		self._nextSequence = 1
+		self._unacked = collections.deque() # (sequence number, FRAME_SEQUENCED frame, message frame) of the messages sent but not acknowledged yet, oldest first
+		self._unackedLock = threading.Lock()
+		self._resendWriter = None # Writer over which unacknowledged messages were last resent
+		self._failedFrames = [] # Frames taken from the queue that could not be sent over a channel that failed or was replaced, to be resent over the next one
+		self._pendingAck = None # (stream ID, sequence number) to acknowledge over our next frames
+		self._ackLock = threading.Lock()
+		self._onWake = None
+		self._lastSent = 0
+		self._lastActive = time.time() # Last time a message other than a heartbeat was queued
+		self._failures = 0 # Consecutive failed connection attempts
+		self._nextAttempt = 0 # Earliest time of the next connection attempt
+		self._retry = threading.Event()
+		self._batchReady = threading.Event() # Set when lingering for more messages to batch should stop
 		KozoThread.__init__(self, name='Connection to ' + str(self._node))
 		self.daemon = True
-	def getSubthreads(self):
-		return [self._heartbeatThread]
+	def getNode(self):
+		return self._node
+	def setWakeCallback(self, callback):
+		"""Sets a function to call whenever a message is queued or the connection is lost, instead of waking up this thread."""
+		self._onWake = callback
+	def _wake(self):
+		if self._onWake is not None:
+			self._onWake()
+		else:
+			self._retry.set()
+			if self._channel is None or self._isBatchFull():
+				self._batchReady.set()
+	def _isBatchFull(self):
+		"""Returns whether enough messages are queued to fill a batch along with the one being sent."""
+		return self.getQueuedCount() + 1 >= kozoConfig('batchMaxMessages')
+	def _linger(self, linger):
+		"""
+		Waits up to linger seconds for more messages to batch with the one being sent, or until enough are queued to fill a batch or the channel is lost.
+		The wait is ended by a timer, as the event loop does with the eventloop runtime mode.
+		"""
+		self._batchReady.clear()
+		if self._channel is None or self._isBatchFull():
+			return
+		timer = kozoRuntime().getTimers().callLater(linger, self._batchReady.set, 'linger')
+		self._batchReady.wait()
+		kozoRuntime().getTimers().cancel(timer)
+	def isConnected(self):
+		return self._channel is not None
+	def getChannel(self):
+		return self._channel
+	def getQueuedCount(self):
+		return len(self._outgoingMessagesQueue)
+	def getDroppedCount(self):
+		dropped = self._outgoingMessagesQueue.getDroppedCount()
+		if self._spool is not None:
+			dropped += self._spool.getDroppedCount()
+		return dropped
+	def _hasPendingMessages(self):
+		if not self._outgoingMessagesQueue.isEmpty():
+			return True
+		if self._spool is None:
+			return False
+		with self._spoolLock:
+			return not self._spool.isEmpty()
+	def isCongested(self):
+		return self._outgoingMessagesQueue.getFill() >= kozoConfig('outgoingQueueHighWatermark')
+	def _isOnDemand(self):
+		return not (kozoSystem().getSelfNode().getSelfToOthersConnectPolicy() == Node.CONNECTPOLICY_CONSTANT and self._node.getOthersToSelfConnectPolicy() == Node.CONNECTPOLICY_CONSTANT)
 	def _shouldConnect(self):
 		selfToRemote = kozoSystem().getSelfNode().getSelfToOthersConnectPolicy()
 		remoteToSelf = self._node.getOthersToSelfConnectPolicy()
@@ -275,62 +922,743 @@ class ConnectionThread(KozoThread):
 					selfToRemote == Node.CONNECTPOLICY_CONSTANT
 				)
 			) or (
-				not self._outgoingMessagesQueue.isEmpty()
+				self._hasPendingMessages()
 			)
 		)
 	def shouldSendHeartbeat(self):
-		return self._channel is not None or self._shouldConnect()
-	def sendMessage(self, message):
-		self._outgoingMessagesQueue.push(message, message.getSize())
-	def _sendBytes(self, bytes):
-		while len(bytes):
-			sentBytes = self._channel.wrapSend(bytes)
-			if sentBytes == 0:
-				return 0
-			bytes = bytes[sentBytes:]
-	def kill(self):
-		KozoThread.kill(self)
+		"""Heartbeats are only needed when nothing else was sent during the last heartbeat period, as the remote end takes any frame as a sign of life."""
+		if self._channel is not None:
+			return time.time() - self._lastSent >= kozoConfig('heartbeat')
+		return self._shouldConnect()
+	def sendMessage(self, message, timeout=0):
+		"""Queues the given message, waiting up to timeout seconds for room if the queue is full. Returns the number of messages dropped to make room for it."""
+		if isinstance(message, Heartbeat):
+			dropped = self._outgoingMessagesQueue.push(message, 0, message.getPriority()) # Heartbeats are usually sent as control frames, so don't serialize them just to know their size.
+		elif self._spool is not None:
+			dropped = self._spoolMessage(message, timeout)
+			self._lastActive = time.time()
+		else:
+			dropped = self._outgoingMessagesQueue.push(message, message.getSize(), message.getPriority(), timeout)
+			self._lastActive = time.time()
+		self._wake()
+		return dropped
+	def _spoolMessage(self, message, timeout):
+		"""Queues the given message, or appends it to the spool if we are not connected, if the queue is full, or if older messages are in the spool already."""
+		with self._spoolLock:
+			if self._channel is None or not self._spool.isEmpty() or not self._outgoingMessagesQueue.hasRoomFor(message.getSize()):
+				frame = message.toStorableFrame()
+				if frame is not None:
+					self._spool.append(frame)
+					return 0
+			return self._outgoingMessagesQueue.push(message, message.getSize(), message.getPriority(), timeout)
+	def _refillFromSpool(self):
+		"""Moves the oldest spooled messages to the queue once it is empty, up to a batch worth of them."""
+		with self._spoolLock:
+			if not self._outgoingMessagesQueue.isEmpty() or self._spool.isEmpty():
+				return
+			maxMessages = kozoConfig('batchMaxMessages')
+			if kozoConfig('outgoingQueueLength') is not None:
+				maxMessages = min(maxMessages, kozoConfig('outgoingQueueLength'))
+			maxSize = kozoConfig('batchMaxSize')
+			if kozoConfig('outgoingQueueSize') is not None:
+				maxSize = min(maxSize, kozoConfig('outgoingQueueSize'))
+			for frame in self._spool.popMany(maxMessages, maxSize):
+				message = decodeFramedMessage(frame)
+				if message is not None:
+					self._outgoingMessagesQueue.push(message, message.getSize(), message.getPriority())
+	def _purgeQueue(self):
+		"""
+		Drops the queued heartbeats after the channel was lost. The queued messages are kept to be sent over the next channel.
+		If the node has a spool, they are put back in front of it instead.
+		"""
+		if self._spool is None:
+			self._outgoingMessagesQueue.purge(lambda m: not isinstance(m, Heartbeat))
+			return
+		with self._spoolLock:
+			messages = self._outgoingMessagesQueue.popMany()
+			self._spool.prepend([frame for frame in (m.toStorableFrame() for m in messages if not isinstance(m, Heartbeat)) if frame is not None])
+	def _defersToPeer(self):
+		"""
+		With bidirectional channels, a node lets the other open the channel if both always connect to each other and the other's name sorts first.
+		The channel opened by that node is the one kept when both open one at the same time anyway.
+		"""
+		selfNode = kozoSystem().getSelfNode()
+		return kozoConfig('bidirectionalChannels') and self._node.getName() < selfNode.getName() and self._node.getSelfToOthersConnectPolicy() == Node.CONNECTPOLICY_CONSTANT and selfNode.getOthersToSelfConnectPolicy() == Node.CONNECTPOLICY_CONSTANT
+	def getStartDelay(self):
+		"""Returns how long to wait before connecting for the first time."""
+		delay = random.uniform(0, kozoConfig('connectionStagger'))
+		if self._defersToPeer():
+			delay += kozoConfig('connectionStagger')
+		return delay
+	def getRetryDelay(self):
+		"""Returns how long to wait before trying to connect again."""
+		if not self._shouldConnect():
+			return kozoConfig('connectionRetry') # Nothing to do until a message gets queued, which wakes us up
+		return max(0, self._nextAttempt - time.time())
+	def closeIfIdle(self, idleTimeout):
+		"""Closes the connection if it is an on-demand one, and no message was queued for the given number of seconds."""
+		channel = self._channel
+		if channel is not None and self._isOnDemand() and time.time() - self._lastActive > idleTimeout:
+			infoRuntime(self, 'Closing idle connection.')
+			kozoRuntime().getConnectionWorkers().submit(self.kill, channel) # Runs as a timer, and killing waits for the message being sent
+
+	def queueAck(self, stream, sequence):
+		"""
+		Acknowledges the given sequence number of the node's stream over our next frames, sending a heartbeat to carry it if nothing else is queued.
+		Without a channel to the node, the acknowledgement waits for one to be opened for other reasons, so that on-demand connections aren't opened just for it.
+		"""
+		with self._ackLock:
+			wasPending = self._pendingAck is not None
+			self._pendingAck = (stream, sequence)
+		if not wasPending and self._channel is not None:
+			self.sendMessage(Heartbeat(self._node))
+	def _takeAckFrame(self, writer):
+		with self._ackLock:
+			ack = self._pendingAck
+			self._pendingAck = None
+		if ack is None or not writer.canSendSequencedFrames():
+			return None
+		return encodeAckFrame(*ack)
+	def acknowledge(self, stream, sequence):
+		"""Forgets the messages the node acknowledged."""
+		if stream != self._stream:
+			return
+		with self._unackedLock:
+			while self._unacked and self._unacked[0][0] <= sequence:
+				self._unacked.popleft()
+	def _sequenceFrame(self, frame):
+		"""
+		Numbers the given message frame, and keeps it in the retransmit window until acknowledged. Older frames are dropped from the window once it is full.
+		Returns the FRAME_SEQUENCED frame to send right before it.
+		"""
+		with self._unackedLock:
+			sequence = self._nextSequence
+			self._nextSequence += 1
+			sequenceFrame = encodeSequencedFrame(self._stream, sequence)
+			self._unacked.append((sequence, sequenceFrame, frame))
+			while len(self._unacked) > kozoConfig('retransmitWindow'):
+				self._unacked.popleft()
+		return sequenceFrame
+	def _resendUnacked(self, writer):
+		"""
+		Resends the unacknowledged messages over a new channel, followed by the other frames that could not be sent over the previous one.
+		The node drops the messages it already received. Returns whether they were all sent; if not, the other frames are kept for the next channel.
+		"""
+		with self._unackedLock:
+			if not writer.canSendSequencedFrames():
+				self._unacked.clear()
+			frames = []
+			for _, sequenceFrame, frame in self._unacked:
+				frames.extend((sequenceFrame, frame))
+			unacked = set(id(sequenceFrame) for _, sequenceFrame, _ in self._unacked)
+		failedFrames, self._failedFrames = self._failedFrames, []
+		if not writer.canSendCompactMessages():
+			frames = [self._storableFrame(frame) for frame in frames]
+			failedFrames = [self._storableFrame(frame) for frame in failedFrames]
+		skipNext = False
+		for frame in failedFrames:
+			if skipNext:
+				skipNext = False
+			elif id(frame) in unacked:
+				skipNext = True # The message frame numbered by it is resent along with it already
+			else:
+				frames.append(frame)
+		if not frames:
+			return True
+		infoRuntime(self, 'Resending', len(frames), 'unacknowledged or unsent frames.')
+		if not self._sendFrames(frames, writer):
+			self._failedFrames[:0] = failedFrames
+			return False
+		return True
+	def _storableFrame(self, frame):
+		"""Returns the given frame, re-encoded without the compact serializer if it is a message frame using it."""
+		if decodeFrameHeader(frame)[0] != FRAME_MESSAGE or not isCompactFrame(frame):
+			return frame
+		message = decodeFramedMessage(frame)
+		storable = None if message is None else message.toStorableFrame()
+		return frame if storable is None else storable # Dropping it would separate it from its FRAME_SEQUENCED frame
+	def _messageFrame(self, message, writer):
+		"""Returns the frame of the given message to send over the given writer, which only uses the compact serializer if the remote end shares its tables."""
+		if writer.canSendCompactMessages():
+			return message.toFrame()
+		return message.toStorableFrame()
+	def _drainFrames(self, firstMessage, writer):
+		"""
+		Returns the frames of the given message and of the messages queued after it.
+		Stops after batchMaxMessages messages or batchMaxSize bytes. Returns None if a message cannot be serialized.
+		Heartbeats are dropped if other messages are sent along with them, and sent as a heartbeat frame if the remote end supports it.
+		Messages are numbered if retransmitWindow is set and the remote end acknowledges them, and a pending acknowledgement is sent along with them.
+		"""
+		sequenced = kozoConfig('retransmitWindow') > 0 and writer.canSendSequencedFrames()
+		maxMessages = kozoConfig('batchMaxMessages')
+		maxSize = kozoConfig('batchMaxSize')
+		frames = []
+		count = 0
+		totalSize = 0
+		heartbeat = None
+		messages = [firstMessage]
+		while messages:
+			for message in messages:
+				if isinstance(message, Heartbeat):
+					heartbeat = message
+					continue
+				frame = self._messageFrame(message, writer)
+				if frame is None:
+					return None
+				if sequenced:
+					sequenceFrame = self._sequenceFrame(frame)
+					frames.append(sequenceFrame)
+					totalSize += len(sequenceFrame)
+				frames.append(frame)
+				count += 1
+				totalSize += len(frame)
+			if count >= maxMessages or totalSize >= maxSize:
+				break
+			messages = self._outgoingMessagesQueue.popMany(maxMessages - count, maxSize - totalSize)
+		ackFrame = self._takeAckFrame(writer)
+		if ackFrame is not None:
+			return [ackFrame] + frames # Acknowledgements also show that we are alive
+		if not frames and heartbeat is not None:
+			if writer.canSendHeartbeatFrames():
+				return [encodeHeartbeatFrame()]
+			frame = self._messageFrame(heartbeat, writer)
+			if frame is None:
+				return None
+			frames.append(frame)
+		return frames
+	def _sendFrames(self, frames, writer):
+		"""
+		Sends the given frames. Consecutive frames are grouped into batch frames of up to batchMaxSize bytes, each sent in a single write, if the remote end supports them.
+		Returns whether they were all sent.
+		"""
+		maxSize = kozoConfig('batchMaxSize') if writer.canSendBatchFrames() else 0
+		group = []
+		groupSize = 0
+		for frame in frames + [None]:
+			if group and (frame is None or groupSize + len(frame) > maxSize):
+				if not writer.write(group[0] if len(group) == 1 else encodeBatchFrame(group)):
+					return False
+				self._lastSent = time.time()
+				group = []
+				groupSize = 0
+			if frame is not None:
+				group.append(frame)
+				groupSize += len(frame)
+		return True
+	def _attemptConnect(self, originTransport, targetTransport, race):
+		"""Connects over the given transports and negotiates capabilities, then puts a (channel, capabilities, reader, transports) tuple in the given _ConnectionRace, or None if this failed."""
+		channel = None
+		try:
+			infoRuntime(self, 'Attempting to connect', originTransport, 'to', targetTransport)
+			start = time.time()
+			channel = originTransport.connect(targetTransport)
+			if channel is None:
+				infoRuntime(self, 'Connection failed (None returned)')
+			else:
+				connected = time.time()
+				capabilities, reader = self._negotiate(channel)
+				# The hello frame is sent as soon as the remote end gets the channel, so waiting for it takes about one round trip.
+				kozoRuntime().getLinkStats().succeeded((originTransport, targetTransport), connected - start, time.time() - connected if capabilities else None)
+				race.put((channel, capabilities, reader, (originTransport, targetTransport)))
+				return
+		except BaseException as e:
+			infoRuntime(self, 'Connection failed', e)
+			if channel is not None:
+				channel.kill()
+		kozoRuntime().getLinkStats().failed((originTransport, targetTransport))
+		race.put(None)
+	def _negotiate(self, channel):
+		"""Returns the capabilities advertised by the remote end of the given channel, and the reader used to read them."""
+		reader = FrameReader(channel, kozoConfig('maxBufferReadSize'))
+		deadline = time.time() + kozoConfig('negotiationTimeout')
+		while time.time() < deadline:
+			frames = reader.read(deadline - time.time())
+			if frames is None:
+				break
+			for frameType, payload in frames:
+				if frameType == FRAME_HELLO:
+					return decodeHelloFrame(payload), reader
+		infoRuntime(self, 'Remote end did not advertise its capabilities; not compressing and sending heartbeats as messages.')
+		return frozenset(), reader
+	def attachChannel(self, channel, writer, duplex, transports=None):
+		"""
+		Starts sending over the given channel, which is either one we opened over the given transports or a bidirectional one the node opened. Returns whether it is used; if not, it is killed.
+		A working channel is only replaced by a bidirectional one. If the working channel is bidirectional too, it is only replaced if the node opened the new one after we started using it.
+		If both nodes opened one at about the same time, both keep the one opened by the node whose name sorts first.
+		"""
+		with self._channelLock:
+			current = self._channel
+			if not channel.isAlive():
+				return False
+			if current is not None and current is not channel and current.isAlive():
+				simultaneous = time.time() - self._attachedAt < kozoConfig('negotiationTimeout')
+				if not duplex or (self._duplex and simultaneous and current.getFromNode().getName() <= channel.getFromNode().getName()):
+					infoRuntime(self, 'Already connected; closing', channel)
+					channel.kill()
+					return False
+				infoRuntime(self, 'Replacing', current, 'with', channel)
+			else:
+				current = None
+			self._channel = channel
+			self._duplex = duplex
+			self._transports = transports
+			self._attachedAt = time.time()
+			self._failures = 0
+		if current is not None:
+			current.kill() # Makes a write in progress over it fail, rather than waiting for it
+		self._setWriter(channel, writer)
+		self._wake()
+		return True
+	def _setWriter(self, channel, writer):
+		"""Starts writing with the given writer, once the message being sent is done, unless the given channel was replaced or closed in the meantime."""
+		with self._sendLock:
+			if self._channel is channel:
+				self._writer = writer
+	def _isCurrent(self, writer):
+		"""Returns whether the given writer writes to the current channel. Only meaningful while holding _sendLock."""
+		return writer is not None and self._writer is writer and self._channel is writer.getChannel()
+	def detachChannel(self, channel):
+		"""Called when the given channel was lost. Fails over to the standby channel if it was using it."""
+		if self._channel is channel:
+			self._failOver(channel)
+	def _failOver(self, failed, unsentFrames=()):
+		"""
+		Called when the given channel failed. Moves traffic to the standby channel if there is a working one, and kills the connection otherwise.
+		The given frames, which were taken from the queue but could not be sent, are sent over the standby channel first, or over the next channel.
+		Never waits: if a heartbeat is being written to the standby channel, it is closed too, and the next connectStep() reconnects.
+		"""
+		with self._sendLock:
+			self._failedFrames.extend(unsentFrames)
+		with self._channelLock:
+			if self._channel is not failed:
+				return # Already replaced or closed
+			standby = self._standby
+			self._standby = None # No more heartbeats are sent over it
+			busy = None
+			if standby is not None and self._standbyIdle.is_set() and standby[0].isAlive():
+				self._channel, self._transports = standby[0], standby[2]
+				self._duplex = False
+				self._attachedAt = time.time()
+			else:
+				busy, standby = standby, None
+		if busy is not None:
+			infoRuntime(self, 'Standby channel', busy[0], 'is busy or dead; reconnecting instead.')
+			busy[0].kill()
+		if standby is None:
+			self.kill(failed)
+			return
+		self._setWriter(standby[0], standby[1])
+		infoRuntime(self, 'Channel', failed, 'failed; switching to standby channel', standby[0])
+		self._nextStandbyAttempt = 0
 		try:
-			self._channel.kill()
+			failed.kill()
 		except:
 			pass
-		self._channel = None
-		self._outgoingMessagesQueue.purge(lambda m: not isinstance(m, Heartbeat))
+		self._wake()
+	def _wantsStandby(self):
+		return self._node.getWarmStandby() and self._channel is not None
+	def _openStandby(self):
+		"""Opens a standby channel, over different transports than the channel if possible."""
+		try:
+			transports = self._transports
+			candidates = [(o, t) for o in kozoSystem().getSelfNode().getTransports() for t in self._node.getTransports() if o.canConnect(t)]
+			if transports is not None:
+				candidates = [c for c in candidates if c[1] is not transports[1]] or [c for c in candidates if c != transports]
+			candidates = kozoRuntime().getLinkStats().sort(candidates, defaultTime=lambda (o, t): 1 + Transport.Priority_BEST - min(o.getPriority(), t.getPriority()))
+			self._nextStandbyAttempt = time.time() + kozoConfig('connectionRetry')
+			if not candidates:
+				return
+			race = _ConnectionRace()
+			self._attemptConnect(candidates[0][0], candidates[0][1], race)
+			result = race.get()
+			if result is None:
+				return
+			channel, capabilities, _, transports = result
+			if b'standby' not in capabilities:
+				infoRuntime(self, 'Remote end does not support standby channels.')
+				channel.kill()
+				return
+			channel.wrapSendAll(encodeHelloFrame(standbyChannel=True))
+			with self._channelLock:
+				if self._wantsStandby() and self._standby is None:
+					self._standby = (channel, FrameWriter(channel, capabilities), transports)
+					channel = None
+			if channel is not None:
+				channel.kill()
+			else:
+				infoRuntime(self, 'Opened standby channel', self._standby[0])
+		finally:
+			self._openingStandby = False
+	def maintainStandby(self):
+		"""
+		Called every heartbeat period. If the node wants a warm standby, opens a standby channel while connected, in the background.
+		Otherwise, sends a heartbeat over the standby channel in the background, so that both ends know it still works.
+		"""
+		if not self._wantsStandby():
+			return
+		with self._channelLock:
+			standby = self._standby
+			if standby is None:
+				if not self._openingStandby and time.time() >= self._nextStandbyAttempt:
+					self._openingStandby = True
+					kozoRuntime().getConnectionWorkers().submit(self._openStandby)
+				return
+			if not self._standbyIdle.is_set():
+				return # The previous heartbeat is still being written
+			self._standbyIdle.clear()
+		kozoRuntime().getConnectionWorkers().submit(self._heartbeatStandby, standby)
+	def _heartbeatStandby(self, standby):
+		"""Sends a heartbeat over the given standby channel. Traffic only moves to the standby channel while this is not running, so that sendStep() never writes to it at the same time."""
+		try:
+			try:
+				if standby[1].write(encodeHeartbeatFrame()):
+					return
+			except BaseException as e:
+				infoRuntime(self, 'Got exception while sending heartbeat over standby channel', e, printTraceback=False)
+			infoRuntime(self, 'Standby channel', standby[0], 'is dead.')
+			with self._channelLock:
+				if self._standby is standby:
+					self._standby = None
+			standby[0].kill()
+		finally:
+			self._standbyIdle.set()
+	def kill(self, channel=None):
+		"""Closes the connection. If a channel is given, only does so if it is still the current one."""
+		KozoThread.kill(self)
+		with self._channelLock:
+			current = self._channel
+			if channel is not None and current is not channel:
+				return
+			standby = self._standby
+			self._standby = None
+			self._channel = None
+			self._duplex = False
+			self._transports = None
+		for dropped in (current, standby and standby[0]):
+			try:
+				dropped.kill() # Makes a write in progress over it fail, rather than waiting for it
+			except:
+				pass
+		with self._sendLock:
+			if self._channel is None:
+				self._writer = None
+		self._purgeQueue()
 		infoRuntime(self, 'Killed')
-	def execute(self):
-		randomWait(kozoConfig('connectionRetry'))
+		if current is not None:
+			if self._defersToPeer():
+				self._nextAttempt = time.time() + self.getStartDelay()
+			self._wake()
+	def connectStep(self):
+		"""
+		Connects to the node if we should, are not connected already, and are not backing off from failed attempts. Returns whether we have a channel to it.
+		Pairs of transports are tried in order of how quickly connecting over them went recently, falling back to their priority until they have been tried.
+		If an attempt takes longer than connectionRaceDelay seconds, the next pair is tried alongside it, and the first to succeed is used.
+		After a failed attempt, waits between connectionBackoff and connectionRetry seconds before the next one, doubling each time.
+		"""
 		originNode = kozoSystem().getSelfNode()
 		targetNode = self._node
-		while True:
-			if self._shouldConnect() and (self._channel is None or not self._channel.isAlive()):
-				for originTransport in sorted(originNode.getTransports(), key=lambda t: t.getPriority(), reverse=True):
-					for targetTransport in sorted(targetNode.getTransports(), key=lambda t: t.getPriority(), reverse=True):
-						if originTransport.canConnect(targetTransport):
-							try:
-								infoRuntime(self, 'Attempting to connect', originTransport, 'to', targetTransport)
-								self._channel = originTransport.connect(targetTransport)
-								if self._channel is None:
-									infoRuntime(self, 'Connection failed (None returned)')
-									continue
-								infoRuntime(self, 'Successful connection', self._channel)
-							except BaseException as e:
-								infoRuntime(self, 'Connection failed', e)
-								self.kill()
-			if self._channel is not None:
-				try:
-					toDeliver = self._outgoingMessagesQueue.pop(True, kozoConfig('connectionRetry'))
-					if toDeliver is not None:
-						messageBytes = toDeliver.toBytes()
-						if messageBytes is None:
-							infoRuntime(self, 'Could not serialize message; killing connection.')
-							self.kill()
-						elif self._sendBytes(_messageMagicHeader + struct.pack('I', len(messageBytes)) + messageBytes) == 0:
-							infoRuntime(self, 'Could not send message; assuming connection is dead.')
-							self.kill()
+		if self._shouldConnect() and (self._channel is None or not self._channel.isAlive()) and time.time() >= self._nextAttempt:
+			candidates = [(o, t) for o in originNode.getTransports() for t in targetNode.getTransports() if o.canConnect(t)]
+			candidates = kozoRuntime().getLinkStats().sort(candidates, defaultTime=lambda (o, t): 1 + Transport.Priority_BEST - min(o.getPriority(), t.getPriority()))
+			raceDelay = kozoConfig('connectionRaceDelay')
+			race = _ConnectionRace()
+			pending = 0
+			result = None
+			while candidates or pending:
+				if candidates:
+					originTransport, targetTransport = candidates.pop(0)
+					if candidates or pending:
+						kozoRuntime().getConnectionWorkers().submit(self._attemptConnect, originTransport, targetTransport, race)
 					else:
-						warnRuntime(self, 'Did not send any mesage during the last period, is heartbeat thread dead?', e)
+						self._attemptConnect(originTransport, targetTransport, race)
+					pending += 1
+				try:
+					result = race.get(raceDelay if candidates and raceDelay is not None else None)
+				except Queue.Empty:
+					continue # Try the next candidate alongside this one
+				pending -= 1
+				if result is not None:
+					break
+			race.finish() # Attempts that lost the race close their channel
+			if result is not None:
+				channel, capabilities, reader, transports = result
+				try:
+					duplex = kozoConfig('bidirectionalChannels') and b'duplex' in capabilities
+					if duplex:
+						channel.wrapSendAll(encodeHelloFrame()) # Tells the node it may send to us over this channel
+					writer = FrameWriter(channel, capabilities)
+					if self.attachChannel(channel, writer, duplex, transports):
+						infoRuntime(self, 'Successful connection', channel, '(compressed)' if writer.isCompressing() else '', '(bidirectional)' if duplex else '')
+						if duplex:
+							kozoRuntime().handOffDuplexChannel(channel, reader)
 				except BaseException as e:
+					infoRuntime(self, 'Connection failed', e)
+					channel.kill()
+			if self._channel is None:
+				self._purgeQueue() # Only once every attempt failed; attempts that lost the race may fail after another one was attached
+				self._failures += 1
+				backoff = min(kozoConfig('connectionRetry'), kozoConfig('connectionBackoff') * 2 ** min(self._failures - 1, 16))
+				self._nextAttempt = time.time() + random.uniform(backoff / 2.0, backoff)
+				infoRuntime(self, 'Could not connect; retrying in %.1f seconds.' % (self._nextAttempt - time.time()))
+			else:
+				self._failures = 0
+		return self._channel is not None
+	def sendStep(self, timeout, linger=None):
+		"""
+		Sends the first message queued for the node, and those queued after it, waiting up to the given timeout for one. Returns whether any were sent.
+		Waits up to linger seconds (batchLinger by default) for more messages to batch with the first one.
+		"""
+		writer = None
+		frames = None
+		try:
+			with self._sendLock:
+				writer = self._writer # The connection may be killed from other threads while we send
+				if not self._isCurrent(writer) or not self._resendIfNew(writer):
+					return False
+			if self._spool is not None:
+				self._refillFromSpool()
+			toDeliver = self._outgoingMessagesQueue.pop(timeout > 0, timeout)
+			if toDeliver is None:
+				return False
+			linger = kozoConfig('batchLinger') if linger is None else linger
+			if linger > 0:
+				self._linger(linger)
+			with self._sendLock:
+				writer = self._writer # Read again, as the channel may have been replaced or lost while waiting for a message
+				if not self._isCurrent(writer) or not self._resendIfNew(writer):
+					if not isinstance(toDeliver, Heartbeat):
+						self._setAside([toDeliver.toStorableFrame()], None) # The next channel may not use the compact serializer
+					return False
+				frames = self._drainFrames(toDeliver, writer)
+				if frames is None:
+					infoRuntime(self, 'Could not serialize message; killing connection.')
+					self.kill(writer.getChannel())
+					return False
+				if not self._sendFrames(frames, writer):
+					self._setAside(frames, writer, 'Could not send message; assuming connection is dead.')
+					return False
+				return True
+		except BaseException as e:
+			with self._sendLock:
+				if self._isCurrent(writer):
 					warnRuntime(self, 'Got exception while trying to send, assuming connection is dead.', e)
-					self.kill()
+				self._setAside(frames or (), writer)
+			return False
+	def _resendIfNew(self, writer):
+		"""Resends the unacknowledged and unsent frames if the given writer is not the one they were last resent over. Returns False, after failing over, if this failed."""
+		if writer is self._resendWriter:
+			return True
+		self._resendWriter = writer
+		if self._resendUnacked(writer):
+			return True
+		self._setAside((), writer, 'Could not resend messages; assuming connection is dead.')
+		return False
+	def _setAside(self, frames, writer, reason=None):
+		"""
+		Keeps the given frames, which could not be sent over the given writer, to be sent over the next channel.
+		Fails over if that writer is still the current one; otherwise, the channel was replaced or lost while they were being sent.
+		Must be called while holding _sendLock.
+		"""
+		frames = [frame for frame in frames if frame is not None]
+		if self._isCurrent(writer):
+			if reason is not None:
+				infoRuntime(self, reason)
+			self._failOver(writer.getChannel(), frames)
+		else:
+			self._failedFrames.extend(frames)
+	def _waitForRetry(self, delay):
+		"""Waits for the given delay, or until woken up by a queued message or a lost connection."""
+		timer = kozoRuntime().getTimers().callLater(delay, self._retry.set, 'reconnect')
+		self._retry.wait()
+		kozoRuntime().getTimers().cancel(timer)
+	def execute(self):
+		self._waitForRetry(self.getStartDelay())
+		while True:
+			self._retry.clear()
+			if self.connectStep():
+				channel = self._channel
+				if not self.sendStep(kozoConfig('connectionRetry')) and self._channel is channel is not None: # Not if the channel failed or changed
+					warnRuntime(self, 'Did not send any message during the last period, are heartbeats being sent?')
+			else:
+				self._waitForRetry(self.getRetryDelay())
+
+class EventLoopThread(KozoThread):
+	"""
+	Drives the whole runtime from a single thread when runtimeMode is 'eventloop'.
+	The loop waits on the incoming channels, and runs the runtime's timers (heartbeats, reconnections, idle channels, batch linger).
+	Everything that may block (roles, connecting, sending) runs on a fixed pool of worker threads instead.
+	"""
+	def __init__(self, numWorkers, timers):
+		KozoThread.__init__(self, name='Event loop')
+		self._workers = WorkerPool(numWorkers, name='Event loop worker')
+		self._timers = timers
+		self._lock = threading.Lock()
+		self._dead = False
+		self._wakeLock = threading.Lock()
+		self._wakeRead, self._wakeWrite = os.pipe()
+		self._woken = False
+		self._newReceptions = []
+		self._receptions = {} # File descriptor -> [ReceptionThread, last activity time]
+		self._parkedRoles = {} # RoleThread -> [timer, wake on message]
+		self._busyConnections = set()
+		self._dirtyConnections = set()
+		self._lingeringConnections = set()
+		self._connectTimers = {} # ConnectionThread -> (timer, due time)
+		self._timers.setEarlierCallback(self._wake)
+	def _wake(self):
+		if threading.current_thread() is self:
+			return
+		with self._wakeLock:
+			if self._woken:
+				return
+			self._woken = True
+		os.write(self._wakeWrite, b'.')
+	def kill(self):
+		KozoThread.kill(self)
+		self._dead = True
+		self._wake()
+	# Roles
+	def addRole(self, roleThread):
+		roleThread.setEventLoop(self)
+		rateControl = roleThread.getRole().getRateControl()
+		self._parkRole(roleThread, 0 if rateControl is None else random.uniform(0, rateControl), True)
+	def _parkRole(self, roleThread, delay, wakeOnMessage):
+		parked = [None, wakeOnMessage]
+		with self._lock:
+			self._parkedRoles[roleThread] = parked
+		parked[0] = self._timers.callLater(delay, lambda: self._unparkRole(roleThread, parked), 'role')
+	def _unparkRole(self, roleThread, parked=None):
+		"""Runs the given role, if it is parked. parked is the parking entry whose timer expired, or None if a message arrived."""
+		with self._lock:
+			current = self._parkedRoles.get(roleThread)
+			if current is None or (parked is None and not current[1]) or (parked is not None and current is not parked):
+				return
+			del self._parkedRoles[roleThread]
+		if parked is None and current[0] is not None:
+			self._timers.cancel(current[0])
+		self._workers.submit(self._runRole, roleThread)
+	def notifyRole(self, roleThread):
+		"""Called when a message is delivered to the given role."""
+		self._unparkRole(roleThread)
+	def _runRole(self, roleThread):
+		if roleThread.isDead() or self._dead:
+			return
+		try:
+			delay = roleThread.runStep()
+		except KozoStopError:
+			return
+		except BaseException as e:
+			warnRuntime(roleThread, 'Stopped with exception', e)
+			return
+		if delay is None:
+			if roleThread.hasMessages():
+				self._parkRole(roleThread, 0, True)
 			else:
-				time.sleep(kozoConfig('connectionRetry'))
+				self._parkRole(roleThread, kozoConfig('connectionRetry'), True)
+		else:
+			self._parkRole(roleThread, delay, roleThread.getRole().getMessageRateControlOverride())
+	# Outgoing connections
+	def addConnection(self, connectionThread):
+		connectionThread.setWakeCallback(lambda: self.notifyConnection(connectionThread))
+		self._scheduleConnect(connectionThread, connectionThread.getStartDelay())
+	def _scheduleConnect(self, connectionThread, delay):
+		"""Schedules a connection attempt after the given delay, unless one is already scheduled sooner."""
+		due = time.time() + delay
+		with self._lock:
+			pending = self._connectTimers.get(connectionThread)
+			if pending is not None:
+				if pending[1] <= due:
+					return
+				self._timers.cancel(pending[0])
+			self._connectTimers[connectionThread] = (self._timers.callLater(delay, lambda: self._connectNow(connectionThread), 'reconnect'), due)
+	def _connectNow(self, connectionThread):
+		with self._lock:
+			del self._connectTimers[connectionThread]
+		self._serviceConnection(connectionThread, True)
+	def notifyConnection(self, connectionThread):
+		"""
+		Called when a message is queued for the given connection, or when it was lost.
+		Sending waits for batchLinger seconds, unless enough messages are already queued to fill a batch.
+		"""
+		if not connectionThread.isConnected():
+			self._scheduleConnect(connectionThread, connectionThread.getRetryDelay())
+			return
+		if kozoConfig('batchLinger') <= 0 or connectionThread.getQueuedCount() >= kozoConfig('batchMaxMessages'):
+			self._serviceConnection(connectionThread, False)
+			return
+		with self._lock:
+			if connectionThread in self._lingeringConnections:
+				return
+			self._lingeringConnections.add(connectionThread)
+		self._timers.callLater(kozoConfig('batchLinger'), lambda: self._endLinger(connectionThread), 'linger')
+	def _endLinger(self, connectionThread):
+		with self._lock:
+			self._lingeringConnections.discard(connectionThread)
+		self._serviceConnection(connectionThread, False)
+	def _serviceConnection(self, connectionThread, connect):
+		with self._lock:
+			if connectionThread in self._busyConnections:
+				self._dirtyConnections.add(connectionThread)
+				return
+			self._busyConnections.add(connectionThread)
+		self._workers.submit(self._sendConnection, connectionThread, connect)
+	def _sendConnection(self, connectionThread, connect):
+		try:
+			if connectionThread.connectStep() if connect else connectionThread.isConnected():
+				while connectionThread.sendStep(0, 0): # Lingering is done with timers instead
+					pass
+		finally:
+			with self._lock:
+				self._busyConnections.discard(connectionThread)
+				again = connectionThread in self._dirtyConnections
+				self._dirtyConnections.discard(connectionThread)
+			if again or not connectionThread.isConnected():
+				self.notifyConnection(connectionThread)
+	# Incoming channels
+	def addReception(self, receptionThread):
+		self._workers.submit(self._greetReception, receptionThread)
+	def _greetReception(self, receptionThread):
+		receptionThread.greet()
+		with self._lock:
+			self._newReceptions.append(receptionThread)
+		self._wake()
+	def _expireReceptions(self):
+		deadline = time.time() - kozoConfig('connectionRetry')
+		for fd, (receptionThread, lastActivity) in self._receptions.items():
+			if lastActivity < deadline:
+				infoRuntime(receptionThread, 'Channel timeout while trying to read message.')
+				receptionThread.kill()
+	def _waitReadable(self, fds, timeout):
+		if hasattr(select, 'poll'):
+			poller = select.poll()
+			for fd in fds:
+				poller.register(fd, select.POLLIN)
+			return [fd for fd, _ in poller.poll(None if timeout is None else int(timeout * 1000))]
+		try:
+			return select.select(fds, [], [], timeout)[0]
+		except (select.error, ValueError):
+			return [] # A channel was closed from another thread; it gets pruned on the next iteration.
+	def execute(self):
+		self._workers.start()
+		self._timers.callEvery(max(0.1, kozoConfig('connectionRetry') / 2.0), self._expireReceptions, 'idle channels')
+		while not self._dead:
+			with self._wakeLock:
+				self._woken = False
+			with self._lock:
+				for receptionThread in self._newReceptions:
+					self._receptions[receptionThread.getChannel().fileno()] = [receptionThread, time.time()]
+				self._newReceptions = []
+			nextTimer = self._timers.getNextTime()
+			for fd, (receptionThread, _) in self._receptions.items():
+				if not receptionThread.getChannel().isAlive():
+					del self._receptions[fd]
+			timeout = None if nextTimer is None else max(0, nextTimer - time.time())
+			for fd in self._waitReadable(self._receptions.keys() + [self._wakeRead], timeout):
+				if fd == self._wakeRead:
+					os.read(self._wakeRead, 4096)
+				elif fd in self._receptions and self._receptions[fd][0].getChannel().isAlive():
+					reception = self._receptions[fd]
+					reception[1] = time.time()
+					if not reception[0].receiveStep(kozoConfig('connectionRetry')):
+						del self._receptions[fd]
+			self._timers.runDue()
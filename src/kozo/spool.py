@@ -0,0 +1,213 @@
+import mmap
+import os
+import struct
+import threading
+import time
+
+class Spool(object):
+	"""
+	A persistent FIFO queue of frames, used to keep messages for a node across outages and restarts.
+	Frames are appended to numbered segment files in the spool directory, and read back from the first segment through a memory map.
+	The read position is kept in a cursor file, so that reopening the spool resumes where it left off.
+	Fully-read segments are deleted, and whole segments are dropped, oldest first, when the spool goes over maxSize bytes.
+	Frames older than maxAge seconds are dropped when read.
+	Frames may also be put back in front of the queue with prepend(), which writes them as a new first segment.
+	"""
+	_recordHeader = struct.Struct('<dI') # Timestamp, frame length
+	_cursor = struct.Struct('<QQQ') # First segment, read offset into it, number of frames read from it
+	_firstSegment = 1 << 32 # New spools start numbering segments from here, leaving room for prepended segments
+
+	def __init__(self, path, maxSize=None, maxAge=None, segmentSize=1024 * 1024):
+		self._path = path
+		self._maxSize = maxSize
+		self._maxAge = maxAge
+		self._segmentSize = segmentSize
+		self._lock = threading.Lock()
+		self._segments = [] # Segment numbers, in order
+		self._info = {} # Segment number -> [size, number of frames, timestamp of the last frame]
+		self._offset = 0 # Read offset into the first segment
+		self._read = 0 # Number of frames read from the first segment
+		self._totalSize = 0
+		self._writer = None # Append handle on the last segment
+		self._map = None # (segment number, mmap) of the first segment
+		self._dropped = 0
+		if not os.path.isdir(path):
+			os.makedirs(path)
+		for name in os.listdir(path):
+			if name.endswith('.seg'):
+				number = int(name[:-4], 16)
+				self._segments.append(number)
+				self._info[number] = self._scanSegment(number)
+				self._totalSize += self._info[number][0]
+		self._segments.sort()
+		self._loadCursor()
+	def _segmentPath(self, number):
+		return os.path.join(self._path, '%016x.seg' % number)
+	def _scanSegment(self, number):
+		"""Returns the [size, number of frames, timestamp of the last frame] of the given segment. Truncates it after its last complete frame, in case we died while writing it."""
+		size, count, lastTime = 0, 0, 0
+		with open(self._segmentPath(number), 'r+b') as handle:
+			while True:
+				header = handle.read(self._recordHeader.size)
+				if len(header) < self._recordHeader.size:
+					break
+				timestamp, length = self._recordHeader.unpack(header)
+				if len(handle.read(length)) < length:
+					break
+				size += self._recordHeader.size + length
+				count += 1
+				lastTime = timestamp
+			handle.truncate(size)
+		return [size, count, lastTime]
+	def _loadCursor(self):
+		try:
+			with open(os.path.join(self._path, 'cursor'), 'rb') as handle:
+				number, offset, read = self._cursor.unpack(handle.read(self._cursor.size))
+		except (IOError, struct.error):
+			return
+		while self._segments and self._segments[0] < number:
+			self._deleteSegment(self._segments[0])
+		if self._segments and self._segments[0] == number and offset <= self._info[number][0]:
+			self._offset, self._read = offset, read
+	def _saveCursor(self):
+		cursorPath = os.path.join(self._path, 'cursor')
+		with open(cursorPath + '.tmp', 'wb') as handle:
+			handle.write(self._cursor.pack(self._segments[0] if self._segments else 0, self._offset, self._read))
+		os.rename(cursorPath + '.tmp', cursorPath)
+	def _closeMap(self):
+		if self._map is not None:
+			self._map[1].close()
+			self._map = None
+	def _closeWriter(self):
+		if self._writer is not None:
+			self._writer.close()
+			self._writer = None
+	def _deleteSegment(self, number):
+		"""Deletes the given segment, which must be the first one."""
+		if self._map is not None and self._map[0] == number:
+			self._closeMap()
+		if self._segments[-1] == number:
+			self._closeWriter()
+		self._segments.pop(0)
+		self._totalSize -= self._info[number][0]
+		del self._info[number]
+		self._offset = self._read = 0
+		os.remove(self._segmentPath(number))
+	def _dropFirstSegment(self):
+		self._dropped += self._info[self._segments[0]][1] - self._read
+		self._deleteSegment(self._segments[0])
+	def isEmpty(self):
+		return not self._segments or (len(self._segments) == 1 and self._offset >= self._info[self._segments[0]][0])
+	def getSize(self):
+		"""Returns the number of bytes used by the spool on disk."""
+		return self._totalSize
+	def getDroppedCount(self):
+		"""Returns how many frames were dropped for being too old, or to keep the spool under its maximum size."""
+		return self._dropped
+	def append(self, frame):
+		record = self._recordHeader.pack(time.time(), len(frame)) + frame
+		with self._lock:
+			if not self._segments or self._info[self._segments[-1]][0] >= self._segmentSize:
+				self._closeWriter()
+				number = self._segments[-1] + 1 if self._segments else self._firstSegment
+				self._segments.append(number)
+				self._info[number] = [0, 0, 0]
+			number = self._segments[-1]
+			if self._writer is None:
+				self._writer = open(self._segmentPath(number), 'ab')
+			self._writer.write(record)
+			self._writer.flush()
+			self._info[number][0] += len(record)
+			self._info[number][1] += 1
+			self._info[number][2] = time.time()
+			self._totalSize += len(record)
+			while self._maxSize is not None and self._totalSize > self._maxSize and len(self._segments) > 1:
+				self._dropFirstSegment()
+	def prepend(self, frames):
+		"""Puts the given frames back in front of the spool, in order."""
+		if not frames:
+			return
+		with self._lock:
+			if self._segments and self._offset:
+				self._compactFirstSegment()
+			number = self._segments[0] - 1 if self._segments else self._firstSegment
+			now = time.time()
+			size = 0
+			with open(self._segmentPath(number), 'wb') as handle:
+				for frame in frames:
+					record = self._recordHeader.pack(now, len(frame)) + frame
+					handle.write(record)
+					size += len(record)
+			self._segments.insert(0, number)
+			self._info[number] = [size, len(frames), now]
+			self._totalSize += size
+			self._offset = self._read = 0
+			self._saveCursor()
+	def _compactFirstSegment(self):
+		"""Rewrites the first segment without the frames that were already read from it."""
+		number = self._segments[0]
+		self._closeMap()
+		if self._segments[-1] == number:
+			self._closeWriter()
+		path = self._segmentPath(number)
+		with open(path, 'rb') as handle:
+			handle.seek(self._offset)
+			remaining = handle.read()
+		with open(path + '.tmp', 'wb') as handle:
+			handle.write(remaining)
+		os.rename(path + '.tmp', path)
+		info = self._info[number]
+		self._totalSize -= info[0] - len(remaining)
+		info[0] = len(remaining)
+		info[1] -= self._read
+		self._offset = self._read = 0
+		self._saveCursor()
+	def _getMap(self, number, needed):
+		"""Returns a memory map of the given segment covering at least the given number of bytes, remapping it if the segment grew."""
+		if self._map is None or self._map[0] != number or len(self._map[1]) < needed:
+			self._closeMap()
+			with open(self._segmentPath(number), 'rb') as handle:
+				self._map = (number, mmap.mmap(handle.fileno(), self._info[number][0], access=mmap.ACCESS_READ))
+		return self._map[1]
+	def popMany(self, maxItems=None, maxBytes=None):
+		"""
+		Pops up to maxItems frames from the front of the spool, stopping before the frame that would bring their total size over maxBytes (but popping at least one).
+		Returns the list of popped frames, possibly empty.
+		"""
+		frames = []
+		totalSize = 0
+		with self._lock:
+			if self.isEmpty():
+				return frames
+			expiry = None if self._maxAge is None else time.time() - self._maxAge
+			while self._segments and (maxItems is None or len(frames) < maxItems):
+				number = self._segments[0]
+				info = self._info[number]
+				if self._offset >= info[0]:
+					if len(self._segments) == 1:
+						break
+					self._deleteSegment(number)
+					continue
+				if expiry is not None and info[2] < expiry:
+					self._dropFirstSegment()
+					continue
+				segment = self._getMap(number, info[0])
+				timestamp, length = self._recordHeader.unpack_from(segment, self._offset)
+				if frames and maxBytes is not None and totalSize + length > maxBytes:
+					break
+				start = self._offset + self._recordHeader.size
+				self._offset = start + length
+				self._read += 1
+				if expiry is not None and timestamp < expiry:
+					self._dropped += 1
+					continue
+				frames.append(segment[start:self._offset])
+				totalSize += length
+			if self._segments and self._offset >= self._info[self._segments[0]][0] and len(self._segments) == 1:
+				self._deleteSegment(self._segments[0]) # Fully read; start over with a fresh segment
+			self._saveCursor()
+		return frames
+	def close(self):
+		with self._lock:
+			self._closeMap()
+			self._closeWriter()
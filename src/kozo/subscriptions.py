@@ -0,0 +1,85 @@
+from .kozo import Role
+from .messages import RoleMessage, Event, Order, _definedMessageClasses
+
+# Wildcard value for Subscription fields, matching any value.
+ANY = '*'
+
+class Subscription(object):
+	"""
+	Declares that a Role is interested in Messages of a given class (or any of its subclasses).
+	The subscription may be further restricted by type (event type or order type), channel, sender node name and sender role name.
+	Each of these restrictions defaults to ANY, which matches any value (including None).
+	"""
+	def __init__(self, messageClass, type=ANY, channel=ANY, senderNode=ANY, senderRole=ANY):
+		self._messageClass = messageClass.__name__
+		self._type = type
+		self._channel = channel
+		self._senderNode = senderNode
+		self._senderRole = senderRole
+	def getIndexKey(self):
+		return (self._messageClass, self._type)
+	def matches(self, fields):
+		"""Returns whether the given (channel, sender node name, sender role name) match this subscription. The class and type are matched by the index."""
+		channel, senderNode, senderRole = fields
+		return (
+			(self._channel == ANY or self._channel == channel) and
+			(self._senderNode == ANY or self._senderNode == senderNode) and
+			(self._senderRole == ANY or self._senderRole == senderRole)
+		)
+
+_messageClassNames = {} # Message class -> names of the message classes it is an instance of
+def _getMessageClassNames(messageClass):
+	if messageClass not in _messageClassNames:
+		_messageClassNames[messageClass] = [c.__name__ for c in messageClass.__mro__ if _definedMessageClasses.get(c.__name__) is c]
+	return _messageClassNames[messageClass]
+
+def _getMessageType(message):
+	if isinstance(message, Event):
+		return message.getEventType()
+	if isinstance(message, Order):
+		return message.getOrderType()
+	return None
+
+def _overridesIsInterestedIn(role):
+	return getattr(type(role).isInterestedIn, '__func__', None) is not Role.isInterestedIn.__func__
+
+class SubscriptionIndex(object):
+	"""
+	Index of the subscriptions of a set of Roles, keyed by message class name and type.
+	Roles that declare subscriptions are only asked isInterestedIn() for messages matching one of them, and only if they override it.
+	Roles that do not declare subscriptions are asked isInterestedIn() for every message, as before.
+	"""
+	def __init__(self, roles):
+		self._index = {}
+		self._unindexed = []
+		for role in roles:
+			subscriptions = role.getSubscriptions()
+			if subscriptions is None:
+				self._unindexed.append(role)
+				continue
+			filtered = _overridesIsInterestedIn(role)
+			for subscription in subscriptions:
+				self._index.setdefault(subscription.getIndexKey(), []).append((subscription, role, filtered))
+	def _candidates(self, message):
+		messageType = _getMessageType(message)
+		for className in _getMessageClassNames(message.__class__):
+			for key in ((className, messageType), (className, ANY)):
+				for candidate in self._index.get(key, ()):
+					yield candidate
+	def _interested(self, message, skip):
+		"""Yields the roles interested in the given message, skipping roles for which skip(role) returns True."""
+		if not isinstance(message, RoleMessage):
+			return
+		fields = (message.getChannel(), message.getSenderName(), message.getSenderRoleName())
+		for subscription, role, filtered in self._candidates(message):
+			if not skip(role) and subscription.matches(fields) and (not filtered or role.isInterestedIn(message)):
+				yield role
+		for role in self._unindexed:
+			if not skip(role) and role.isInterestedIn(message):
+				yield role
+	def getInterestedRoles(self, message):
+		roles = set()
+		return [role for role in self._interested(message, roles.__contains__) if not roles.add(role)]
+	def getInterestedNodes(self, message):
+		nodes = set()
+		return [role.getNode() for role in self._interested(message, lambda role: role.getNode() in nodes) if not nodes.add(role.getNode())]
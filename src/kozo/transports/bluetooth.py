@@ -28,6 +28,10 @@ class BluetoothTransport(AuthenticatedTransport):
 		self._serverSocket.listen(self['socketConnectionBacklog'])
 		bluetooth.advertise_service(self._serverSocket, 'kozo', service_id=self._uuid, service_classes=[self._uuid, bluetooth.SERIAL_PORT_CLASS], profiles=[bluetooth.SERIAL_PORT_PROFILE])
 		infoTransport(self, 'Bound on port', self._serverSocket.getsockname()[1], 'with UUID', self._uuid)
+	def unbind(self):
+		if self._serverSocket is not None:
+			self._serverSocket.close()
+			self._serverSocket = None
 	def getUnauthenticatedConnectAddresses(self, otherTransport):
 		return [(otherTransport._address, otherTransport._uuid)]
 	def getUnauthenticatedSocket(self, otherTransport, addressIndex, address):
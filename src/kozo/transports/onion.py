@@ -56,6 +56,10 @@ class OnionTransport(Transport):
 			self._serverSocket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
 			self._serverSocket.bind(('localhost', self['port']))
 			self._serverSocket.listen(self['socketConnectionBacklog'])
+	def unbind(self):
+		if self._serverSocket is not None:
+			self._serverSocket.close()
+			self._serverSocket = None
 	def getPriority(self):
 		return Transport.Priority_MEH
 	def canAccept(self):
@@ -190,12 +194,24 @@ class OnionChannel(Channel):
 		self._sock.close()
 	def send(self, bytes):
 		return self._sock.send(bytes)
-	def receive(self, bytes, timeout):
+	def sendAll(self, data):
+		self._sock.sendall(data)
+		return True
+	def _receiveWithTimeout(self, receive, timeout):
+		previousTimeout = self._sock.gettimeout()
 		self._sock.settimeout(timeout)
 		try:
-			return self._sock.recv(bytes)
+			return receive()
 		except socket.timeout:
 			return None
+		finally:
+			self._sock.settimeout(previousTimeout) # The timeout also applies to sends
+	def receive(self, bytes, timeout):
+		return self._receiveWithTimeout(lambda: self._sock.recv(bytes), timeout)
+	def receiveInto(self, buffer, timeout):
+		return self._receiveWithTimeout(lambda: self._sock.recv_into(buffer), timeout)
+	def fileno(self):
+		return self._sock.fileno()
 	def __str__(self):
 		return 'Onion' + Channel.__str__(self)
 
@@ -20,6 +20,10 @@ class TCPTransport(AuthenticatedTransport):
 		self._serverSocket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
 		self._serverSocket.bind((self['bindAddress'], self['port']))
 		self._serverSocket.listen(self['socketConnectionBacklog'])
+	def unbind(self):
+		if self._serverSocket is not None:
+			self._serverSocket.close()
+			self._serverSocket = None
 	def getUnauthenticatedConnectAddresses(self, otherTransport):
 		return [(address,  otherTransport['port']) for address in otherTransport['address']]
 	def getUnauthenticatedSocket(self, otherTransport, addressIndex, address):